@@ -1,7 +1,24 @@
 file-search-bot/
 ├── bot.py               # Main bot logic and handlers
 ├── config.py            # Config with API keys, IDs, etc.
+├── settings.py          # Runtime tunables, stored in Mongo and changed with /set
 ├── database.py          # MongoDB file/user handling
+├── utils.py             # Caption normalization, tokenizing and release-tag noise
+├── cache.py             # In-process TTL/LRU cache
+├── indexer.py           # Batched, resumable channel indexer for /indexall
+├── ratelimit.py         # Token bucket shared by outbound senders
+├── pool.py              # Several bot tokens in one process, with a send budget each
+├── admission.py         # Per-user rate limits and load shedding for search traffic
+├── broadcast.py         # Rate-limited, resumable /broadcast engine
+├── users.py             # Write-behind registry of known users
+├── handles.py           # Short query handles for pagination callbacks
+├── delivery.py          # Ordered, batched file delivery per destination chat
+├── memindex.py          # In-memory caption index with mmap snapshots
+├── inline.py            # Inline query paging, debouncing and coalescing
+├── metrics.py           # Latency, cache and FloodWait metrics with a /metrics endpoint
+├── jobs.py              # Job queue to worker processes (Redis or local)
+├── ingest.py            # Batched live indexing of channel posts, edits and deletions
+├── bench.py             # Offline benchmark with a stub client and in-memory Mongo
 ├── requirements.txt     # Python dependencies
 ├── Dockerfile           # For container deployment (optional)
 ├── README.md            # Project overview
@@ -11,6 +28,9 @@ file-search-bot/
 API_ID = 12345678
 API_HASH = "your_api_hash"
 BOT_TOKEN = "your_bot_token"
+# More bots served next to BOT_TOKEN, sharing its handlers, caches and index (pool.py).
+# Each needs the same rights in the index, force-sub and log chats.
+BOT_TOKENS = []
 MONGO_URI = "your_mongo_uri"
 
 FORCE_CHANNEL = -1001234567890
@@ -18,6 +38,73 @@ FORCE_GROUP = -1009876543210
 LOG_CHANNEL = -1001122334455
 BOT_OWNER_ID = 111111111
 INDEX_CHANNELS = [-1001234567890]
+SEND_FILE_INSTEAD_OF_LINK = False
+
+# Defaults for the tunables in settings.py, which the owner can change at runtime
+PAGE_SIZE = 5
+SETTINGS_REFRESH = 30
+# Per user: USER_RATE searches, page turns or inline queries a second, bursts of
+# USER_BURST. At most MAX_INFLIGHT_SEARCHES run at once per process. 0 turns either off.
+USER_RATE = 1
+USER_BURST = 5
+MAX_INFLIGHT_SEARCHES = 64
+
+SEARCH_COUNT_CAP = 1000
+RESULT_CACHE_SIZE = 2048
+RESULT_CACHE_TTL = 300
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+INLINE_CACHE_TIME = 60
+# Telegram serves cached inline answers without asking the bot. Shared between users,
+# they would skip the force-sub check (per-user rate limits don't matter there, as a
+# cached answer costs the bot nothing), so they stay personal while one is required.
+INLINE_IS_PERSONAL = bool(FORCE_CHANNEL or FORCE_GROUP)
+INLINE_PAGE_SIZE = 50
+INLINE_DEBOUNCE = 0.3
+PAGE_DEBOUNCE = 0.4
+CAPTION_INDEX_PATH = "caption_index.snap"
+# Also how often files added since are folded into the ranked part of the index
+CAPTION_SNAPSHOT_INTERVAL = 600
+
+# Metrics are served on http://METRICS_HOST:METRICS_PORT/metrics; port 0 turns it off
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+METRICS_LAG_INTERVAL = 1
+
+# Worker processes for searches, indexing and broadcasts; 0 runs everything in the bot
+# process. Files are written by the bot process and reach the workers' caption indexes
+# through Mongo change streams, so any WORKERS needs a replica set (a single node one
+# will do); the bot won't start without. With REDIS_URL the queues live in Redis and
+# workers are started separately (python bot.py --worker N), otherwise the bot spawns them.
+WORKERS = 0
+REDIS_URL = ""
+WORKER_CONCURRENCY = 32
+FORCE_SUB_CACHE_SIZE = 100000
+FORCE_SUB_TTL = 300
+FORCE_SUB_NEGATIVE_TTL = 15
+ADMISSION_CACHE_SIZE = 100000
+ADMISSION_WARN_TTL = 10
+# /indexall, /dedup and /delete hold a lease in Mongo, renewed while they run, so only
+# one runs at a time across the bot and its workers
+INDEX_LEASE_TTL = 60
+MONGO_POOL_SIZE = 32
+MONGO_TIMEOUT_MS = 5000
+INDEX_BATCH_SIZE = 500
+INGEST_QUEUE_SIZE = 2000
+INGEST_BATCH_SIZE = 200
+INGEST_FLUSH_INTERVAL = 0.5
+INGEST_RETRIES = 3
+INDEX_PROGRESS_INTERVAL = 10
+BROADCAST_WORKERS = 20
+BROADCAST_RATE = 25
+BROADCAST_CHUNK = 1000
+BROADCAST_RETRIES = 3
+BROADCAST_PROGRESS_INTERVAL = 15
+USER_FLUSH_INTERVAL = 30
+HANDLE_CACHE_SIZE = 100000
+HANDLE_TTL = 24 * 3600
+HANDLE_RESULT_IDS = 200
+DELIVERY_CONCURRENCY = 8
+DELIVERY_RETRIES = 3
 
 
 # requirements.txt
@@ -26,42 +113,2763 @@ pyrogram==2.0.106
 tgcrypto==1.2.5
 pymongo[srv]
 humanize
+redis>=4.2
 
 
 # database.py
 
-from pymongo import MongoClient
-from config import MONGO_URI
-
-client = MongoClient(MONGO_URI)
+import asyncio
+import functools
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+from pymongo import MongoClient, TEXT, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from config import MONGO_URI, MONGO_POOL_SIZE, MONGO_TIMEOUT_MS, SEARCH_COUNT_CAP, RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_MAX_BYTES, CAPTION_INDEX_PATH, INDEX_BATCH_SIZE
+from cache import TTLCache
+from memindex import CaptionIndex
+from metrics import observe, watch_cache
+from utils import tokenize, query_tokens, parse_release, parse_filters, RELEASE_VERSION
+
+# "mongomock://" runs on an in-memory stand-in (bench.py); it has no change streams
+# and no $text, so only unfiltered searches from the caption index work there
+IN_MEMORY = MONGO_URI.startswith("mongomock://")
+if IN_MEMORY:
+    import mongomock
+    client = mongomock.MongoClient()
+else:
+    client = MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_POOL_SIZE,
+        serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+        connectTimeoutMS=MONGO_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_TIMEOUT_MS * 6,
+    )
 db = client["file_search"]
 
+# pymongo blocks, so every call runs here; one thread per pooled connection
+_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
 files_collection = db["files"]
 users_collection = db["users"]
+meta_collection = db["meta"]
+
+def _result_size(value):
+    if isinstance(value, list):
+        return 64 + 40 * len(value)
+    if isinstance(value, tuple) and isinstance(value[0], str):
+        return 64 + 2 * len(value[0])
+    files = value[0] if isinstance(value, tuple) else []
+    return 64 + sum(200 + len(f["caption"]) for f in files)
+
+result_cache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_MAX_BYTES, _result_size)
+caption_index = CaptionIndex()
+watch_cache("results", result_cache)
+
+async def run_sync(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        # Includes the wait for a free pool thread, which is what the caller sees
+        observe("mongo_seconds", time.perf_counter() - start, op=getattr(func, "__name__", "call"))
+
+def ensure_indexes():
+    files_collection.create_index("file_id")
+    files_collection.create_index([("chat_id", 1), ("message_id", 1)])
+    files_collection.create_index("tokens")
+    files_collection.create_index([("tokens", TEXT)], default_language="none", name="tokens_text")
+    # Filtered searches ("year:2021 q:1080p") are answered from these
+    files_collection.create_index([("release.year", 1), ("release.quality", 1)])
+    files_collection.create_index([("release.season", 1), ("release.episode", 1)])
+    files_collection.create_index([("release.lang", 1), ("release.quality", 1)])
+    # Upserts match on this; the unique index below may not exist until /dedup has run
+    files_collection.create_index("file_unique_id")
+    try:
+        ensure_unique_files()
+    except OperationFailure:
+        # Duplicates saved before dedup existed; /dedup collapses them and retries
+        pass
 
-def save_file(file_id, caption, message_id, chat_id):
-    data = {
+def ensure_unique_files():
+    if IN_MEMORY:
+        # mongomock enforces unique indexes by scanning the collection on every write
+        return
+    files_collection.create_index(
+        [("file_unique_id", 1), ("file_size", 1)],
+        unique=True,
+        partialFilterExpression={"file_unique_id": {"$type": "string"}},
+        name="file_unique",
+    )
+
+def file_doc(file_id, caption, message_id, chat_id, meta=None):
+    return {
         "file_id": file_id,
         "caption": caption or "",
+        "tokens": tokenize(caption),
+        "release": parse_release(caption),
         "message_id": message_id,
         "chat_id": chat_id,
+        **(meta or {}),
+    }
+
+LOCATION_FIELDS = ("file_id", "caption", "tokens", "release", "message_id", "chat_id")
+
+def _upsert(data):
+    # A file's id differs per chat, so the same upload posted in several channels is
+    # matched on file_unique_id and size instead (or file_id for records saved before
+    # media fields were stored). The first post is kept; a repost only refreshes the
+    # media fields.
+    key = {"file_id": data["file_id"]}
+    if data.get("file_unique_id"):
+        # $type lets the partial unique index answer it
+        unique = {"$eq": data["file_unique_id"], "$type": "string"}
+        key = {"$or": [{"file_unique_id": unique, "file_size": data.get("file_size")}, key]}
+    update = {"$setOnInsert": {f: data[f] for f in LOCATION_FIELDS}}
+    media = {f: v for f, v in data.items() if f not in LOCATION_FIELDS}
+    if media:
+        update["$set"] = media
+    return key, update
+
+def _index_file(chat_id, message_id, caption):
+    # Only once loaded: load_caption_index catches up on files saved before that, and
+    # the bot process with WORKERS set never loads it, so would only pile them up
+    if caption_index.ready:
+        caption_index.add(chat_id, message_id, caption)
+
+def _add_stats(files, size, stale):
+    update = {"$inc": {"files": files, "size": size}}
+    if stale:
+        # A repost can fill in the size of a record saved before sizes were stored
+        update["$set"] = {"stale": True}
+    meta_collection.update_one({"_id": "stats"}, update)
+
+async def save_files(docs, invalidate=False):
+    # Unordered bulk upsert, one round trip per batch instead of per file
+    if not docs:
+        return 0
+    try:
+        result = await run_sync(files_collection.bulk_write, [UpdateOne(*_upsert(d), upsert=True) for d in docs], ordered=False)
+        upserted, matched = result.upserted_ids, result.matched_count
+    except BulkWriteError as e:
+        # Concurrent channel walks racing to insert the same file; the loser is a duplicate
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+        upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+        matched = e.details.get("nMatched", 0)
+    for i in upserted:
+        d = docs[i]
+        _index_file(d["chat_id"], d["message_id"], d["caption"])
+        if invalidate:
+            invalidate_results(d["tokens"])
+    await run_sync(_add_stats, len(upserted), sum(docs[i].get("file_size") or 0 for i in upserted), bool(matched))
+    return len(upserted)
+
+def _locations_spec(refs):
+    by_chat = {}
+    for chat_id, message_id in refs:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    return {"$or": [{"chat_id": chat_id, "message_id": {"$in": ids}} for chat_id, ids in by_chat.items()]}
+
+CAPTION_FIELDS = ("caption", "tokens", "release")
+
+def _edit_files(docs):
+    spec = _locations_spec([(d["chat_id"], d["message_id"]) for d in docs])
+    old = {(d["chat_id"], d["message_id"]): d for d in files_collection.find(spec, {"chat_id": 1, "message_id": 1, "tokens": 1})}
+    ops = []
+    for d in docs:
+        prev = old.get((d["chat_id"], d["message_id"]))
+        if prev:
+            ops.append(UpdateOne({"_id": prev["_id"]}, {"$set": {f: d[f] for f in CAPTION_FIELDS}}))
+    if ops:
+        files_collection.bulk_write(ops, ordered=False)
+    return old
+
+async def edit_files(docs):
+    # New captions for messages already saved; an edited post we never saw is saved as new
+    old = await run_sync(_edit_files, docs)
+    for d in docs:
+        prev = old.get((d["chat_id"], d["message_id"]))
+        if prev:
+            _index_file(d["chat_id"], d["message_id"], d["caption"])
+            invalidate_results(prev.get("tokens") or [])
+            invalidate_results(d["tokens"])
+    await save_files([d for d in docs if (d["chat_id"], d["message_id"]) not in old], invalidate=True)
+    return len(old)
+
+def invalidate_results(tokens=None):
+    # Drop cached queries the new caption could match, or everything after a bulk write.
+    # Mongo matches whole words or prefixes; the caption index also typos and split or
+    # joined words, so it is asked whether it would find the caption for each query.
+    if tokens is None:
+        return result_cache.clear()
+    matched = {}
+    for key in result_cache.keys():
+        query = key[1]
+        if query not in matched:
+            matched[query] = all(any(t.startswith(q) for t in tokens) for q in query) or (
+                caption_index.ready and caption_index.matches(" ".join(query), tokens)
+            )
+        if matched[query]:
+            result_cache.pop(key)
+
+def _backfill_batch(after, batch_size):
+    # The next batch_size files by _id, so each batch is a walk of the _id index rather
+    # than a collection scan for the few still missing the fields. Release fields are
+    # parsed again too, in case parse_release changed since the file was saved.
+    spec = {"_id": {"$gt": after}} if after is not None else {}
+    docs = list(files_collection.find(spec, {"caption": 1, "tokens": 1, "release": 1}).sort("_id", 1).limit(batch_size))
+    updates = []
+    for d in docs:
+        fields = {"release": parse_release(d.get("caption"))}
+        if "tokens" not in d:
+            fields["tokens"] = tokenize(d.get("caption"))
+        if fields != {"release": d.get("release")}:
+            updates.append(UpdateOne({"_id": d["_id"]}, {"$set": fields}))
+    if updates:
+        files_collection.bulk_write(updates, ordered=False)
+    return docs[-1]["_id"] if docs else None, len(updates)
+
+async def backfill_tokens(batch_size=1000):
+    # Files saved before the text index or release fields existed are invisible to search,
+    # and ones saved before a parse_release change are mislabelled for filters
+    total = 0
+    after = None
+    while True:
+        after, done = await run_sync(_backfill_batch, after, batch_size)
+        if after is None:
+            return total
+        total += done
+
+async def migrate_releases():
+    # Runs the backfill once per RELEASE_VERSION: release fields are only written when a
+    # file is first saved, so a parse_release change otherwise never reaches older files
+    state = await run_sync(meta_collection.find_one, {"_id": "releases"}) or {}
+    if state.get("version") == RELEASE_VERSION:
+        return 0
+    total = await backfill_tokens()
+    await run_sync(meta_collection.update_one, {"_id": "releases"}, {"$set": {"version": RELEASE_VERSION}}, upsert=True)
+    invalidate_results()
+    return total
+
+def _search_spec(tokens, found=None):
+    release = {f"release.{k}": v for k, v in (found or {}).items()}
+    if not tokens:
+        return release, [("_id", 1)]
+    # Ranked match on whole words first, every query word must be present
+    ranked = {"$text": {"$search": " ".join(tokens)}, "tokens": {"$all": tokens}, **release}
+    if files_collection.find_one(ranked, {"_id": 1}):
+        return ranked, [("score", {"$meta": "textScore"})]
+    # Nothing matched whole words, treat them as prefixes (e.g. a half typed title)
+    prefixes = [re.compile("^" + re.escape(t)) for t in tokens]
+    return {"tokens": {"$all": prefixes}, **release}, [("_id", 1)]
+
+def _search_files(tokens, skip, limit, found=None):
+    spec, sort = _search_spec(tokens, found)
+    projection = {"score": {"$meta": "textScore"}} if "$text" in spec else None
+    return list(files_collection.find(spec, projection).sort(sort).skip(skip).limit(limit))
+
+def _search_refs(tokens, limit, found=None):
+    spec, sort = _search_spec(tokens, found)
+    projection = {"chat_id": 1, "message_id": 1}
+    if "$text" in spec:
+        projection["score"] = {"$meta": "textScore"}
+    return [(d["chat_id"], d["message_id"]) for d in files_collection.find(spec, projection).sort(sort).limit(limit)]
+
+def _count_files(tokens, cap, found=None):
+    spec, _ = _search_spec(tokens, found)
+    return files_collection.count_documents(spec, limit=cap)
+
+# Once the caption index has loaded, reads are served from memory; Mongo stays the
+# source of truth and the index follows it through save_files and the change stream.
+# Queries with filters go to Mongo, which has the release fields indexed.
+
+def parse_query(query):
+    text, found = parse_filters(query)
+    return query_tokens(text), found
+
+async def search_files(query, skip=0, limit=0):
+    tokens, found = parse_query(query)
+    if not tokens and not found:
+        return []
+    if caption_index.ready and not found:
+        return caption_index.search(query, skip, limit or len(caption_index))[0]
+    return await run_sync(_search_files, tokens, skip, limit, found)
+
+async def search_refs(query, limit):
+    # (chat_id, message_id) of the best matches, enough to page through later
+    tokens, found = parse_query(query)
+    if not tokens and not found:
+        return []
+    key = ("refs", tuple(tokens), limit, tuple(sorted(found.items())))
+    refs = result_cache.get(key)
+    if refs is None:
+        if caption_index.ready and not found:
+            docs, _ = caption_index.find(query, 0, limit)
+            refs = [(r.chat_id, r.message_id) for r in map(caption_index.record, docs)]
+        else:
+            refs = await run_sync(_search_refs, tokens, limit, found)
+        result_cache.set(key, refs)
+    return refs
+
+async def get_files(refs):
+    if caption_index.ready:
+        return [r for r in (caption_index.get(*ref) for ref in refs) if r is not None]
+    if not refs:
+        return []
+    spec = {"$or": [{"chat_id": chat_id, "message_id": message_id} for chat_id, message_id in refs]}
+    docs = await run_sync(list, files_collection.find(spec))
+    by_ref = {(d["chat_id"], d["message_id"]): d for d in docs}
+    return [by_ref[ref] for ref in refs if ref in by_ref]
+
+async def search_page(query, page, limit):
+    tokens, found = parse_query(query)
+    key = ("page", tuple(tokens), page, limit, tuple(sorted(found.items())))
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+    # One extra row tells us whether a next page exists without counting
+    files = await search_files(query, skip=(page - 1) * limit, limit=limit + 1)
+    result = files[:limit], len(files) > limit
+    result_cache.set(key, result)
+    return result
+
+async def count_files(query, cap=SEARCH_COUNT_CAP):
+    tokens, found = parse_query(query)
+    if not tokens and not found:
+        return 0
+    key = ("count", tuple(tokens), tuple(sorted(found.items())))
+    total = result_cache.get(key)
+    if total is None:
+        if caption_index.ready and not found:
+            total = caption_index.count(query, cap)
+        else:
+            total = await run_sync(_count_files, tokens, cap, found)
+        result_cache.set(key, total)
+    return total
+
+def _preview_delete(spec, sample):
+    captions = [d["caption"] for d in files_collection.find(spec, {"caption": 1}).limit(sample)]
+    return files_collection.count_documents(spec), captions
+
+async def preview_delete(query, sample=5):
+    tokens, found = parse_query(query)
+    if not tokens and not found:
+        return 0, []
+    spec, _ = await run_sync(_search_spec, tokens, found)
+    return await run_sync(_preview_delete, spec, sample)
+
+def _matching_ids(spec):
+    return [d["_id"] for d in files_collection.find(spec, {"_id": 1}).sort("_id", 1)]
+
+def _delete_batch(ids):
+    docs = list(files_collection.find({"_id": {"$in": ids}}, {"chat_id": 1, "message_id": 1, "file_size": 1}))
+    _delete_docs(docs)
+    return docs
+
+def _delete_docs(docs):
+    if docs:
+        files_collection.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+        size = sum(d.get("file_size") or 0 for d in docs)
+        meta_collection.update_one({"_id": "stats"}, {"$inc": {"files": -len(docs), "size": -size}})
+
+async def delete_files_by_query(query, progress=None):
+    # Deletes what preview_delete counted: Mongo's whole word or prefix match, which is
+    # stricter than /search once the caption index serves it (typos, split words).
+    # The matching _ids are read once, then deleted INDEX_BATCH_SIZE at a time so a
+    # broad query never holds up live traffic.
+    tokens, found = parse_query(query)
+    if not tokens and not found:
+        return 0
+    spec, _ = await run_sync(_search_spec, tokens, found)
+    ids = await run_sync(_matching_ids, spec)
+    deleted = 0
+    for start in range(0, len(ids), INDEX_BATCH_SIZE):
+        docs = await run_sync(_delete_batch, ids[start:start + INDEX_BATCH_SIZE])
+        for d in docs:
+            caption_index.remove(d["chat_id"], d["message_id"])
+        invalidate_results()
+        deleted += len(docs)
+        if progress is not None:
+            progress["deleted"] = deleted
+    return deleted
+
+def _delete_locations(refs):
+    docs = list(files_collection.find(_locations_spec(refs), {"chat_id": 1, "message_id": 1, "file_size": 1, "tokens": 1}))
+    _delete_docs(docs)
+    return docs
+
+async def delete_locations(refs):
+    # Files whose channel post was deleted
+    docs = await run_sync(_delete_locations, refs)
+    for d in docs:
+        caption_index.remove(d["chat_id"], d["message_id"])
+        invalidate_results(d.get("tokens") or [])
+    return len(docs)
+
+def _aggregate_file_stats():
+    rows = list(files_collection.aggregate([
+        {"$group": {"_id": None, "files": {"$sum": 1}, "size": {"$sum": "$file_size"}}}
+    ]))
+    stats = {"files": rows[0]["files"], "size": rows[0]["size"]} if rows else {"files": 0, "size": 0}
+    meta_collection.update_one({"_id": "stats"}, {"$set": {**stats, "stale": False}}, upsert=True)
+    return stats
+
+async def mark_stats_stale():
+    # Bulk writes can't tell which sizes changed, so the next read recomputes
+    await run_sync(meta_collection.update_one, {"_id": "stats"}, {"$set": {"stale": True}})
+
+async def get_file_stats():
+    stats = await run_sync(meta_collection.find_one, {"_id": "stats"})
+    if stats is None or stats.get("stale"):
+        stats = await run_sync(_aggregate_file_stats)
+    return stats
+
+async def get_broadcast():
+    return await run_sync(meta_collection.find_one, {"_id": "broadcast", "done": False})
+
+async def save_broadcast(**fields):
+    await run_sync(meta_collection.update_one, {"_id": "broadcast"}, {"$set": fields}, upsert=True)
+
+async def get_users_after(last_id, limit):
+    cursor = users_collection.find({"_id": {"$gt": last_id}}, {"bots": 1}).sort("_id", 1).limit(limit)
+    return await run_sync(list, cursor)
+
+def _files_without_media(after, limit):
+    spec = {"file_unique_id": {"$exists": False}}
+    if after:
+        spec["_id"] = {"$gt": after}
+    return list(files_collection.find(spec, {"chat_id": 1, "message_id": 1}).sort("_id", 1).limit(limit))
+
+async def files_without_media(after, limit):
+    return await run_sync(_files_without_media, after, limit)
+
+async def set_media(updates):
+    # (_id, fields) pairs; a file whose message is gone gets file_unique_id None.
+    # Returns the _ids that turned out to duplicate a file already stored.
+    if not updates:
+        return []
+    try:
+        await run_sync(files_collection.bulk_write, [UpdateOne({"_id": i}, {"$set": f}) for i, f in updates], ordered=False)
+    except BulkWriteError as e:
+        if any(err["code"] != 11000 for err in e.details["writeErrors"]):
+            raise
+        return [updates[err["index"]][0] for err in e.details["writeErrors"]]
+    return []
+
+def _duplicate_ids():
+    groups = files_collection.aggregate([
+        {"$match": {"file_unique_id": {"$type": "string"}}},
+        {"$group": {"_id": {"u": "$file_unique_id", "s": "$file_size"}, "ids": {"$push": "$_id"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    # All but the oldest copy of each file
+    return [i for g in groups for i in sorted(g["ids"])[1:]]
+
+def _drop_files(ids):
+    docs = list(files_collection.find({"_id": {"$in": ids}}, {"chat_id": 1, "message_id": 1}))
+    files_collection.delete_many({"_id": {"$in": ids}})
+    return [(d["chat_id"], d["message_id"]) for d in docs]
+
+async def drop_files(ids):
+    refs = await run_sync(_drop_files, ids)
+    for ref in refs:
+        caption_index.remove(*ref)
+    return len(refs)
+
+async def collapse_duplicates(progress):
+    ids = await run_sync(_duplicate_ids)
+    for start in range(0, len(ids), INDEX_BATCH_SIZE):
+        progress["removed"] += await drop_files(ids[start:start + INDEX_BATCH_SIZE])
+    if ids:
+        invalidate_results()
+        await mark_stats_stale()
+    await run_sync(ensure_unique_files)
+    return len(ids)
+
+async def delete_users(user_ids):
+    if user_ids:
+        await run_sync(users_collection.delete_many, {"_id": {"$in": list(user_ids)}})
+
+def _build_caption_index():
+    index = CaptionIndex()
+    for d in files_collection.find({}, {"chat_id": 1, "message_id": 1, "caption": 1}).sort("_id", 1):
+        index.add(d["chat_id"], d["message_id"], d.get("caption", ""))
+        index.last_id = str(d["_id"])
+    return index.compact("", len(index.records), set(), index.last_id, None)
+
+def _files_after(last_id):
+    spec = {"_id": {"$gt": ObjectId(last_id)}} if last_id else {}
+    return list(files_collection.find(spec, {"chat_id": 1, "message_id": 1, "caption": 1}).sort("_id", 1))
+
+def _apply_change(change, resume_token):
+    op = change["operationType"]
+    doc = change.get("fullDocument")
+    if op in ("insert", "update", "replace") and doc:
+        caption_index.add(doc["chat_id"], doc["message_id"], doc.get("caption", ""))
+        invalidate_results(doc.get("tokens") or [])
+        if op == "insert":
+            caption_index.last_id = str(doc["_id"])
+    elif op == "delete" and change.get("fullDocumentBeforeChange"):
+        doc = change["fullDocumentBeforeChange"]
+        record = caption_index.get(doc["chat_id"], doc["message_id"])
+        caption_index.remove(doc["chat_id"], doc["message_id"])
+        invalidate_results(doc.get("tokens") or tokenize(record.caption if record else ""))
+    caption_index.resume_token = resume_token
+
+def _pre_images():
+    # Delete events carry the deleted document only with pre-images turned on for the
+    # collection (MongoDB 6.0+); otherwise they name nothing but its _id
+    try:
+        if tuple(client.server_info()["versionArray"][:2]) < (6, 0):
+            return False
+        db.command("collMod", files_collection.name, changeStreamPreAndPostImages={"enabled": True})
+        return True
+    except PyMongoError:
+        return False
+
+def _file_locations():
+    return {d["_id"]: (d["chat_id"], d["message_id"]) for d in files_collection.find({}, {"chat_id": 1, "message_id": 1})}
+
+def _keep_files(live):
+    # Files deleted while nobody could tell us where they were posted
+    stale = [key for key in caption_index.slots if key not in live]
+    for key in stale:
+        caption_index.remove(*key)
+    if stale:
+        invalidate_results()
+
+def _track_location(change, locations):
+    key = change.get("documentKey", {}).get("_id")
+    doc = change.get("fullDocument")
+    if change["operationType"] == "delete":
+        location = locations.pop(key, None)
+        if location:
+            change["fullDocumentBeforeChange"] = {"chat_id": location[0], "message_id": location[1]}
+    elif doc:
+        locations[key] = (doc["chat_id"], doc["message_id"])
+
+def _watch_files(loop, resume_token):
+    # Runs on its own thread for the life of the process. Changes made by other
+    # processes reach the index here; our own writes arrive twice, which is harmless.
+    # Without pre-images, deletes are resolved from an _id -> location map read each
+    # time the stream opens; reading it after the stream opened leaves no gap, and
+    # anything in the index that Mongo no longer has is dropped.
+    pre_images = _pre_images()
+    options = {"full_document_before_change": "whenAvailable"} if pre_images else {}
+    while True:
+        try:
+            with files_collection.watch(full_document="updateLookup", resume_after=resume_token, **options) as stream:
+                locations = None
+                if not pre_images:
+                    locations = _file_locations()
+                    loop.call_soon_threadsafe(_keep_files, set(locations.values()))
+                for change in stream:
+                    if locations is not None:
+                        _track_location(change, locations)
+                    loop.call_soon_threadsafe(_apply_change, change, stream.resume_token)
+        except OperationFailure:
+            if resume_token is None:
+                return
+            # The snapshot's token fell off the oplog; follow from now on
+            resume_token = None
+        except PyMongoError:
+            # Standalone servers have no change streams; in-process updates still apply
+            return
+
+async def load_caption_index():
+    # Restore from the snapshot when there is one, otherwise build from Mongo off the
+    # loop. Inserts since then are caught up by _id and the rest replayed from the
+    # change stream, starting at the snapshot's resume token.
+    index = None
+    if CAPTION_INDEX_PATH and os.path.exists(CAPTION_INDEX_PATH):
+        try:
+            index = await run_sync(CaptionIndex.load, CAPTION_INDEX_PATH)
+        except (OSError, ValueError):
+            index = None
+    if index is None:
+        index = await run_sync(_build_caption_index)
+    caption_index.replace(index)
+    for d in await run_sync(_files_after, caption_index.last_id):
+        caption_index.add(d["chat_id"], d["message_id"], d.get("caption", ""))
+        caption_index.last_id = str(d["_id"])
+    if not IN_MEMORY:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=_watch_files, args=(loop, caption_index.resume_token), daemon=True).start()
+
+async def save_caption_index(write=True):
+    # Folds the files added since the last compaction into the ranked base, so searches
+    # keep stopping early, and writes the snapshot unless `write` is off
+    if not caption_index.ready:
+        return
+    # Taken together on the loop: the change stream moves last_id and the resume token
+    # on while the snapshot is written, past files it doesn't hold
+    upto = caption_index.base + len(caption_index.records)
+    dead = set(caption_index.dead)
+    path = CAPTION_INDEX_PATH if write else ""
+    index = await run_sync(caption_index.compact, path, upto, dead, caption_index.last_id, caption_index.resume_token)
+    caption_index.rebase(index, upto, dead)
+
+async def run_caption_snapshots(interval, write=True):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await save_caption_index(write)
+        except OSError:
+            pass
+
+def change_streams():
+    # Replica sets and sharded clusters have them, standalone servers don't
+    if IN_MEMORY:
+        return False
+    try:
+        with files_collection.watch(max_await_time_ms=1):
+            return True
+    except PyMongoError:
+        return False
+
+async def take_lease(name, owner, ttl):
+    # The lease doc is ours if it is free, expired or already ours; otherwise the upsert
+    # collides with the holder's doc
+    now = time.time()
+    spec = {"_id": f"lease:{name}", "$or": [{"until": {"$lt": now}}, {"owner": owner}]}
+    try:
+        await run_sync(meta_collection.update_one, spec, {"$set": {"owner": owner, "until": now + ttl}}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def drop_lease(name, owner):
+    await run_sync(meta_collection.delete_one, {"_id": f"lease:{name}", "owner": owner})
+
+async def get_checkpoint(chat_id):
+    return await run_sync(meta_collection.find_one, {"_id": f"index:{chat_id}"}) or {}
+
+async def set_checkpoint(chat_id, **fields):
+    await run_sync(meta_collection.update_one, {"_id": f"index:{chat_id}"}, {"$set": fields}, upsert=True)
+
+async def get_total_file_count():
+    return await run_sync(files_collection.estimated_document_count)
+
+async def get_total_user_count():
+    return await run_sync(users_collection.estimated_document_count)
+
+ensure_indexes()
+
+
+# cache.py
+
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    def __init__(self, maxsize, ttl, max_bytes=0, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None and item[0] < time.monotonic():
+            self.pop(key)
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[2]
+
+    def set(self, key, value, ttl=None):
+        self.pop(key)
+        size = self.sizeof(value) if self.sizeof else 0
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes and self.bytes > self.max_bytes):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self.bytes -= size
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        self.bytes -= item[1]
+        return item[2]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def keys(self):
+        return list(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# utils.py
+
+import re
+import unicodedata
+
+_word_re = re.compile(r"[^\W_]+")
+
+def normalize_text(text):
+    # Case and accent folding, so "Amélie" and "AMELIE" index the same way
+    text = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in text if not unicodedata.combining(c)).casefold()
+
+def tokenize(text):
+    return _word_re.findall(normalize_text(text))
+
+# Release tags that say nothing about the title: resolution, codecs, sources, containers
+_noise_re = re.compile(
+    r"\d{3,4}p|4k|[xh]26[45]|hevc|avc|10bit|hdr\d*|aac\d*|e?ac3|dts|ddp?\d*|atmos"
+    r"|webrip|webdl|dl|hdrip|bluray|brrip|bdrip|dvdrip|hdtv|remux|mkv|mp4|avi|esubs?"
+)
+
+def is_noise(token):
+    return _noise_re.fullmatch(token) is not None
+
+def query_tokens(text):
+    # A pasted file name should find the title even if we only have another release of it
+    tokens = tokenize(text)
+    return [t for t in tokens if not is_noise(t)] or tokens
+
+_year_re = re.compile(r"(?:19|20)\d\d")
+_quality_re = re.compile(r"\d{3,4}p")
+_episode_re = re.compile(r"s(\d{1,2})(?:e(\d{1,3}))?|e(\d{1,3})")
+CODECS = {"x264": "x264", "h264": "x264", "avc": "x264", "x265": "x265", "h265": "x265", "hevc": "x265", "av1": "av1", "xvid": "xvid"}
+LANGUAGES = {
+    "english": "en", "hindi": "hi", "tamil": "ta", "telugu": "te", "malayalam": "ml", "kannada": "kn",
+    "bengali": "bn", "spanish": "es", "french": "fr", "korean": "ko", "japanese": "ja",
+}
+# Also ordinary words ("Ben.Hur", "Tel Aviv"), so only taken next to other release tags
+LANGUAGE_CODES = {
+    "eng": "en", "hin": "hi", "tam": "ta", "tel": "te", "mal": "ml", "kan": "kn",
+    "ben": "bn", "spa": "es", "fre": "fr", "kor": "ko", "jpn": "ja",
+}
+
+def _is_tag(token):
+    return (
+        is_noise(token) or token in CODECS or token in LANGUAGES
+        or _year_re.fullmatch(token) is not None or _episode_re.fullmatch(token) is not None
+    )
+
+def _tagged_code(tokens, i):
+    # A run of codes like "Tam.Tel.Hin" counts when a release tag sits on either side
+    start, end = i, i
+    while start and tokens[start - 1] in LANGUAGE_CODES:
+        start -= 1
+    while end + 1 < len(tokens) and tokens[end + 1] in LANGUAGE_CODES:
+        end += 1
+    return (start and _is_tag(tokens[start - 1])) or (end + 1 < len(tokens) and _is_tag(tokens[end + 1]))
+
+# Bumped when parse_release changes what it finds, so stored files are parsed again
+# (migrate_releases)
+RELEASE_VERSION = 2
+
+def parse_release(caption):
+    # Release metadata in a caption like "Dune.2021.1080p.WEB-DL.Hindi.English.x265"
+    info = {}
+    langs = set()
+    tokens = tokenize(caption)
+    for i, t in enumerate(tokens):
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else ""
+        if i and "year" not in info and _year_re.fullmatch(t):
+            # Not the first word, so "2012" or "1917" stay titles
+            info["year"] = int(t)
+        elif "quality" not in info and (t == "4k" or _quality_re.fullmatch(t)):
+            info["quality"] = "2160p" if t == "4k" else t
+        elif "codec" not in info and t in CODECS:
+            info["codec"] = CODECS[t]
+        elif t in LANGUAGES:
+            langs.add(LANGUAGES[t])
+        elif t in LANGUAGE_CODES and _tagged_code(tokens, i):
+            langs.add(LANGUAGE_CODES[t])
+        elif t == "season" and nxt.isdigit():
+            info["season"] = int(nxt)
+        elif t in ("episode", "ep") and nxt.isdigit():
+            info["episode"] = int(nxt)
+        elif m := _episode_re.fullmatch(t):
+            season, episode, alone = m.groups()
+            if season:
+                info["season"] = int(season)
+            if episode or alone and "season" in info:
+                info["episode"] = int(episode or alone)
+    if langs:
+        info["lang"] = sorted(langs)
+    return info
+
+FILTER_KEYS = {
+    "year": "year", "y": "year", "quality": "quality", "q": "quality", "res": "quality",
+    "codec": "codec", "lang": "lang", "l": "lang", "season": "season", "s": "season",
+    "episode": "episode", "ep": "episode", "e": "episode",
+}
+
+def _filter_value(field, value):
+    value = normalize_text(value)
+    if field in ("year", "season", "episode"):
+        return int(value) if value.isdigit() else None
+    if field == "quality":
+        value = "2160p" if value == "4k" else value + "p" if value.isdigit() else value
+        return value if _quality_re.fullmatch(value) else None
+    if field == "codec":
+        return CODECS.get(value)
+    return LANGUAGES.get(value) or LANGUAGE_CODES.get(value) or (value if value in LANGUAGES.values() else None)
+
+def parse_filters(text):
+    # "dune year:2021 q:1080p" -> ("dune", {"year": 2021, "quality": "1080p"});
+    # anything that isn't a known filter stays part of the text
+    words, found = [], {}
+    for word in (text or "").split():
+        key, sep, value = word.partition(":")
+        field = FILTER_KEYS.get(key.casefold()) if sep else None
+        value = _filter_value(field, value) if field else None
+        if value is None:
+            words.append(word)
+        else:
+            found[field] = value
+    return " ".join(words), found
+
+def normalize_query(text):
+    # Canonical query text, filters included, for cache and handle keys
+    text, found = parse_filters(text)
+    return " ".join(query_tokens(text) + [f"{k}:{v}" for k, v in sorted(found.items())])
+
+MEDIA_FIELDS = ("file_unique_id", "file_name", "file_size", "mime_type", "duration")
+
+def media_meta(media):
+    # Whatever the Document/Video/Audio carries, so /stats never has to ask Telegram again
+    return {f: getattr(media, f) for f in MEDIA_FIELDS if getattr(media, f, None) is not None}
+
+def message_link(chat_id, message_id):
+    # t.me/c/ takes the channel id without its -100 prefix
+    return f"https://t.me/c/{-chat_id - 10**12}/{message_id}"
+
+
+# pool.py
+
+from ratelimit import TokenBucket
+
+class ClientPool:
+    # Every bot token runs as its own Client in one process: they share the handlers,
+    # Mongo and every cache, but Telegram rate limits each bot separately, so each gets
+    # its own send bucket. A bot can only message users who have started it, so a
+    # user's bots are kept as a bitmask over `clients` (see users.py), and sends that
+    # any of them could make go through the one with the most budget left.
+    def __init__(self):
+        self.clients = []
+        self.buckets = []
+
+    def add(self, client, rate):
+        self.clients.append(client)
+        self.buckets.append(TokenBucket(rate))
+
+    def index(self, client):
+        for i, c in enumerate(self.clients):
+            if c is client:
+                return i
+        return 0
+
+    def mask(self):
+        return (1 << len(self.clients)) - 1
+
+    def pick(self, mask):
+        best = None
+        for i, bucket in enumerate(self.buckets):
+            if mask >> i & 1 and (best is None or bucket.budget() > self.buckets[best].budget()):
+                best = i
+        return best
+
+    async def acquire(self, client):
+        # Sends outside a broadcast spend the same budget, so pick() sees all of a bot's traffic
+        if self.buckets:
+            await self.buckets[self.index(client)].acquire()
+
+    def pause(self, client, seconds):
+        if self.buckets:
+            self.buckets[self.index(client)].pause(seconds)
+
+    def set_rate(self, rate):
+        for bucket in self.buckets:
+            bucket.set_rate(rate)
+
+    def share_handlers(self, source, client):
+        # Handlers land in source.dispatcher once its loop has run, i.e. after start()
+        for group, handlers in source.dispatcher.groups.items():
+            for handler in handlers:
+                client.add_handler(handler, group)
+
+pool = ClientPool()
+
+
+# settings.py
+
+import asyncio
+
+import config
+from database import run_sync, meta_collection
+
+# Tunables that can change while the bot runs. config.py holds the defaults; /set
+# stores an override in the meta collection and applies it at once, and every process
+# re-reads them every SETTINGS_REFRESH seconds so workers follow. Handlers read
+# settings.<name> when they run; state built from a setting registers on_change.
+FIELDS = {
+    "send_files": (bool, "SEND_FILE_INSTEAD_OF_LINK"),
+    "page_size": (int, "PAGE_SIZE"),
+    "page_debounce": (float, "PAGE_DEBOUNCE"),
+    "inline_page_size": (int, "INLINE_PAGE_SIZE"),
+    "inline_cache_time": (int, "INLINE_CACHE_TIME"),
+    "inline_debounce": (float, "INLINE_DEBOUNCE"),
+    "result_cache_ttl": (int, "RESULT_CACHE_TTL"),
+    "force_sub_ttl": (int, "FORCE_SUB_TTL"),
+    "force_sub_negative_ttl": (int, "FORCE_SUB_NEGATIVE_TTL"),
+    "broadcast_rate": (float, "BROADCAST_RATE"),
+    "user_rate": (float, "USER_RATE"),
+    "user_burst": (int, "USER_BURST"),
+    "max_inflight": (int, "MAX_INFLIGHT_SEARCHES"),
+}
+
+# Telegram takes at most 50 results per inline answer
+MAXIMUM = {"inline_page_size": 50}
+
+def default(name):
+    return getattr(config, FIELDS[name][1])
+
+def parse_value(name, text):
+    kind = FIELDS[name][0]
+    if kind is bool:
+        if text.lower() in ("1", "true", "on", "yes"):
+            return True
+        if text.lower() in ("0", "false", "off", "no"):
+            return False
+        raise ValueError(text)
+    value = kind(text)
+    if value < 0 or (name in ("page_size", "inline_page_size", "broadcast_rate") and not value):
+        raise ValueError(text)
+    if value > MAXIMUM.get(name, value):
+        raise ValueError(text)
+    return value
+
+class Settings:
+    def __init__(self):
+        self.hooks = {}
+        for name in FIELDS:
+            setattr(self, name, default(name))
+
+    def on_change(self, name, hook):
+        self.hooks.setdefault(name, []).append(hook)
+        hook(getattr(self, name))
+
+    def apply(self, values):
+        for name, value in values.items():
+            if name in FIELDS and getattr(self, name) != value:
+                setattr(self, name, value)
+                for hook in self.hooks.get(name, ()):
+                    hook(value)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in FIELDS]
+
+    async def load(self):
+        doc = await run_sync(meta_collection.find_one, {"_id": "settings"}) or {}
+        self.apply({name: doc.get(name, default(name)) for name in FIELDS})
+
+    async def set(self, name, value):
+        await run_sync(meta_collection.update_one, {"_id": "settings"}, {"$set": {name: value}}, upsert=True)
+        self.apply({name: value})
+
+    async def reset(self, name):
+        await run_sync(meta_collection.update_one, {"_id": "settings"}, {"$unset": {name: ""}})
+        self.apply({name: default(name)})
+
+    async def run(self, interval=config.SETTINGS_REFRESH):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except Exception:
+                pass
+
+settings = Settings()
+
+
+# admission.py
+
+import functools
+
+from cache import TTLCache
+from config import ADMISSION_CACHE_SIZE, ADMISSION_WARN_TTL
+from metrics import inc, watch_gauge
+from ratelimit import TokenBucket
+from settings import settings
+
+# Searches, page turns and inline queries pass admit() before any force-sub check or
+# search runs, so one user hammering the bot only spends their own budget. shed() caps
+# how many run at once in this process and turns the rest away instead of queueing
+# them behind a slow Mongo.
+SLOW_DOWN = "🐢 Slow down a little, please try again in a few seconds."
+
+buckets = TTLCache(ADMISSION_CACHE_SIZE, 600)
+warned = TTLCache(ADMISSION_CACHE_SIZE, ADMISSION_WARN_TTL)
+inflight = {"searches": 0}
+watch_gauge("searches_inflight", lambda: inflight["searches"])
+
+def _reset_buckets(_):
+    buckets.clear()
+
+settings.on_change("user_rate", _reset_buckets)
+settings.on_change("user_burst", _reset_buckets)
+
+def admit(user_id, kind):
+    if settings.user_rate:
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(settings.user_rate, settings.user_burst or 1)
+            buckets.set(user_id, bucket)
+        if not bucket.try_acquire():
+            inc("admission_rejected_total", kind=kind, reason="user")
+            return False
+    inc("admission_admitted_total", kind=kind)
+    return True
+
+def should_warn(user_id):
+    # One "slow down" per user per ADMISSION_WARN_TTL; replying to every rejected
+    # request would spend the bot's own send budget on the abuser
+    if warned.get(user_id):
+        return False
+    warned.set(user_id, True)
+    return True
+
+def shed(kind, busy):
+    # Over the in-flight cap the call goes to busy() with the same arguments instead
+    def wrap(func):
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            if settings.max_inflight and inflight["searches"] >= settings.max_inflight:
+                inc("admission_rejected_total", kind=kind, reason="busy")
+                return await busy(*args, **kwargs)
+            inflight["searches"] += 1
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                inflight["searches"] -= 1
+        return inner
+    return wrap
+
+
+# indexer.py
+
+import asyncio
+import contextlib
+import time
+import uuid
+from collections import defaultdict
+
+from pyrogram.errors import FloodWait
+
+from config import INDEX_BATCH_SIZE, INDEX_PROGRESS_INTERVAL, INDEX_LEASE_TTL
+from database import file_doc, save_files, get_checkpoint, set_checkpoint, invalidate_results, files_without_media, set_media, drop_files, collapse_duplicates, mark_stats_stale, take_lease, drop_lease
+from metrics import inc
+from utils import media_meta
+
+async def _renew(name, owner):
+    while True:
+        await asyncio.sleep(INDEX_LEASE_TTL / 3)
+        try:
+            await take_lease(name, owner, INDEX_LEASE_TTL)
+        except Exception:
+            pass
+
+@contextlib.asynccontextmanager
+async def index_lease(name="index"):
+    # Yields whether we got it. Shared by the bot and its workers, unlike an asyncio
+    # lock, and renewed while held; a holder that dies lets it lapse within the TTL.
+    owner = uuid.uuid4().hex
+    if not await take_lease(name, owner, INDEX_LEASE_TTL):
+        yield False
+        return
+    renewer = asyncio.create_task(_renew(name, owner))
+    try:
+        yield True
+    finally:
+        renewer.cancel()
+        await drop_lease(name, owner)
+
+async def index_channel(client, chat_id, progress):
+    # History is walked newest to oldest. Everything at or below "last_id" is indexed;
+    # "top"/"low" describe an unfinished pass, which a restart resumes below "low".
+    cp = await get_checkpoint(chat_id)
+    last_id, top, low = cp.get("last_id", 0), cp.get("top"), cp.get("low") or 0
+    batch = []
+    async for m in client.get_chat_history(chat_id, offset_id=low):
+        if m.id <= last_id:
+            break
+        if top is None:
+            top = m.id
+        media = m.document or m.video or m.audio
+        if media:
+            batch.append(file_doc(media.file_id, m.caption, m.id, m.chat.id, media_meta(media)))
+        if len(batch) >= INDEX_BATCH_SIZE:
+            await save_files(batch)
+            progress[chat_id] += len(batch)
+            batch = []
+            await set_checkpoint(chat_id, top=top, low=m.id)
+    await save_files(batch)
+    progress[chat_id] += len(batch)
+    await set_checkpoint(chat_id, last_id=top or last_id, top=None, low=None)
+
+def progress_text(progress, started):
+    total = sum(progress.values())
+    elapsed = max(time.monotonic() - started, 1)
+    lines = [f"`{chat_id}`: {count}" for chat_id, count in progress.items()]
+    return f"📦 Indexing... {total} files ({total / elapsed:.0f}/s)\n\n" + "\n".join(lines)
+
+async def report_progress(status, render):
+    while True:
+        await asyncio.sleep(INDEX_PROGRESS_INTERVAL)
+        try:
+            await status.edit_text(render())
+        except Exception:
+            pass
+
+async def index_channels(client, chat_ids, status):
+    progress = dict.fromkeys(chat_ids, 0)
+    started = time.monotonic()
+    reporter = asyncio.create_task(report_progress(status, lambda: progress_text(progress, started)))
+    try:
+        results = await asyncio.gather(
+            *(index_channel(client, chat_id, progress) for chat_id in chat_ids),
+            return_exceptions=True,
+        )
+    finally:
+        reporter.cancel()
+        invalidate_results()
+    errors = {chat_id: r for chat_id, r in zip(chat_ids, results) if isinstance(r, Exception)}
+    return sum(progress.values()), errors
+
+async def fetch_messages(client, chat_id, message_ids):
+    try:
+        return await client.get_messages(chat_id, message_ids)
+    except FloodWait as e:
+        inc("floodwait_total", where="indexer")
+        await asyncio.sleep(e.value)
+        return await client.get_messages(chat_id, message_ids)
+
+async def backfill_media(client, progress):
+    # Files indexed before media fields were stored have no file_unique_id to dedup on,
+    # so look their messages up again, 200 per request
+    after = None
+    while True:
+        docs = await files_without_media(after, INDEX_BATCH_SIZE)
+        if not docs:
+            return
+        after = docs[-1]["_id"]
+        by_chat = defaultdict(list)
+        for d in docs:
+            by_chat[d["chat_id"]].append(d)
+        updates = []
+        for chat_id, group in by_chat.items():
+            for start in range(0, len(group), 200):
+                part = group[start:start + 200]
+                try:
+                    messages = await fetch_messages(client, chat_id, [d["message_id"] for d in part])
+                except Exception:
+                    continue
+                found = {m.id: m.document or m.video or m.audio for m in messages if not m.empty}
+                for d in part:
+                    media = found.get(d["message_id"])
+                    updates.append((d["_id"], media_meta(media) if media else {"file_unique_id": None}))
+        duplicates = await set_media(updates)
+        if duplicates:
+            progress["removed"] += await drop_files(duplicates)
+        progress["checked"] += len(docs)
+
+async def dedup_files(client, status):
+    progress = {"checked": 0, "removed": 0}
+    reporter = asyncio.create_task(report_progress(
+        status, lambda: f"🧹 Deduplicating... checked {progress['checked']}, removed {progress['removed']}"
+    ))
+    try:
+        await backfill_media(client, progress)
+        await mark_stats_stale()
+        await collapse_duplicates(progress)
+    finally:
+        reporter.cancel()
+    return progress
+
+
+# ratelimit.py
+
+import asyncio
+import time
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # At least one token, or a rate below 1/s could never afford a single send
+        self.capacity = max(capacity or rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self._refill()
+        if time.monotonic() < self.paused_until or self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens=1):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def budget(self):
+        # Sends available right now; a paused bucket has none
+        self._refill()
+        return self.tokens if time.monotonic() >= self.paused_until else 0
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def pause(self, seconds):
+        # A FloodWait applies to the whole bot, so every sender sharing the bucket backs off
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# memindex.py
+
+import bisect
+import heapq
+import io
+import itertools
+import json
+from collections import Counter
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from utils import tokenize, query_tokens
+
+PREFIX_EXPANSION = 64
+FUZZY_MIN_LEN = 4
+FUZZY_CANDIDATES = 100
+FUZZY_EXPANSIONS = 8
+FUZZY_BUCKET_LIMIT = 20000
+MAGIC = b"CAPIDX02"
+HEADER = struct.Struct("<8s6Q")
+
+def trigrams(token, prefix=False):
+    # Padded so the first and last letters weigh as much as the middle ones; a word
+    # still being typed gets no end marker.
+    padded = f"${token}" if prefix else f"${token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    # Levenshtein distance, giving up with limit + 1 as soon as it is exceeded
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+class Record:
+    __slots__ = ("chat_id", "message_id", "caption")
+
+    def __init__(self, chat_id, message_id, caption):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.caption = caption
+
+    def __getitem__(self, key):
+        # Handlers read records the same way as Mongo documents
+        return getattr(self, key)
+
+class CaptionIndex:
+    # Doc numbers below `base` come from a compacted snapshot (mmap'd from disk, or in
+    # memory): column arrays for the records and one postings array sliced per token,
+    # read without copying. Base docs are numbered best first, shorter captions then
+    # newer ones, so their postings come out in rank order and a search can stop as
+    # soon as it has enough. Docs added since are Records with array-backed postings
+    # of their own, and are folded into the base at the next compaction. Replaced or
+    # removed docs go into `dead` until then.
+    # `grams` maps trigrams to the vocabulary words containing them, for typo matching.
+    def __init__(self):
+        self.base = 0
+        self.columns = None
+        self.base_postings = {}
+        self.records = []
+        self.postings = {}
+        self.vocab = []
+        self.grams = {}
+        self.dead = set()
+        self.last_id = None
+        self.resume_token = None
+        self.ready = False
+        self._slots = None
+        self._mmap = None
+
+    def __len__(self):
+        return self.base + len(self.records) - len(self.dead)
+
+    def replace(self, other):
+        vars(self).update(vars(other))
+        self.ready = True
+
+    @property
+    def slots(self):
+        # (chat_id, message_id) -> doc, built on the first update after a load
+        if self._slots is None:
+            slots = {}
+            if self.columns:
+                slots = dict(zip(zip(self.columns[0], self.columns[1]), range(self.base)))
+            for doc, r in enumerate(self.records, self.base):
+                if doc not in self.dead:
+                    slots[(r.chat_id, r.message_id)] = doc
+            self._slots = slots
+        return self._slots
+
+    def record(self, doc):
+        if doc >= self.base:
+            return self.records[doc - self.base]
+        chat_ids, message_ids, offsets, blob = self.columns
+        return Record(chat_ids[doc], message_ids[doc], str(blob[offsets[doc]:offsets[doc + 1]], "utf-8"))
+
+    def get(self, chat_id, message_id):
+        doc = self.slots.get((chat_id, message_id))
+        return None if doc is None else self.record(doc)
+
+    def _caption_len(self, doc):
+        if doc >= self.base:
+            return len(self.records[doc - self.base].caption.encode())
+        offsets = self.columns[2]
+        return offsets[doc + 1] - offsets[doc]
+
+    def _age(self, doc):
+        # Smaller is newer: base docs are numbered newest first among equal lengths,
+        # and every doc added since is newer than all of them
+        return doc if doc < self.base else self.base - 1 - doc
+
+    def _rank(self, doc):
+        return self._caption_len(doc), self._age(doc)
+
+    def add(self, chat_id, message_id, caption):
+        key = (chat_id, message_id)
+        old = self.slots.get(key)
+        if old is not None:
+            if self.record(old).caption == caption:
+                return
+            self.dead.add(old)
+        doc = self.base + len(self.records)
+        self.records.append(Record(chat_id, message_id, caption))
+        self.slots[key] = doc
+        for token in set(tokenize(caption)):
+            token = sys.intern(token)
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array("I")
+                if token not in self.base_postings:
+                    bisect.insort(self.vocab, token)
+                    self._add_grams(token)
+            postings.append(doc)
+
+    def _add_grams(self, token):
+        for gram in trigrams(token):
+            self.grams.setdefault(gram, []).append(token)
+
+    def remove(self, chat_id, message_id):
+        doc = self.slots.pop((chat_id, message_id), None)
+        if doc is not None:
+            self.dead.add(doc)
+
+    def _prefix_tokens(self, prefix):
+        start = bisect.bisect_left(self.vocab, prefix)
+        return list(itertools.takewhile(lambda t: t.startswith(prefix), self.vocab[start:start + PREFIX_EXPANSION]))
+
+    def _known(self, token):
+        return token in self.postings or token in self.base_postings
+
+    def similar(self, token, prefix=False):
+        # Vocabulary words within one typo of `token` (two for longer words). Candidates
+        # are the words sharing most trigrams with it; very common trigrams are skipped
+        # so the work stays bounded however large the vocabulary gets.
+        limit = 1 if len(token) < 7 else 2
+        grams = trigrams(token, prefix)
+        shared = Counter()
+        for gram in grams:
+            words = self.grams.get(gram, ())
+            if len(words) <= FUZZY_BUCKET_LIMIT:
+                shared.update(words)
+        found = []
+        for word, _ in shared.most_common(FUZZY_CANDIDATES):
+            if prefix:
+                dist = min(edit_distance(token, word[:n], limit) for n in range(len(token) - 1, len(token) + 2))
+            else:
+                dist = edit_distance(token, word, limit)
+            if dist <= limit:
+                found.append((dist, word))
+        return sorted(found)[:FUZZY_EXPANSIONS]
+
+    # A query term is a list of alternatives, (typos, parts): a doc matches one when
+    # it holds every part, a part being a vocabulary word or a nested term. Terms are
+    # walked in doc order and checked by binary search, never built into sets.
+
+    def _size(self, part):
+        if isinstance(part, str):
+            return len(self.base_postings.get(part, ())) + len(self.postings.get(part, ()))
+        return sum(min(map(self._size, parts)) for _, parts in part)
+
+    def _typos(self, part, doc):
+        # Fewest typos `part` matches `doc` with, None if it doesn't
+        if isinstance(part, str):
+            docs = self.base_postings.get(part, ()) if doc < self.base else self.postings.get(part, ())
+            i = bisect.bisect_left(docs, doc)
+            return 0 if i < len(docs) and docs[i] == doc else None
+        best = None
+        for dist, parts in part:
+            for p in parts:
+                typos = self._typos(p, doc)
+                if typos is None:
+                    break
+                dist += typos
+            else:
+                if best is None or dist < best:
+                    best = dist
+        return best
+
+    def _least_typos(self, term):
+        return min((dist + sum(self._least_typos(p) for p in parts if not isinstance(p, str)) for dist, parts in term), default=0)
+
+    def _docs(self, part, live):
+        # Ascending docs matching `part` among the base docs, or the ones added since;
+        # a doc may repeat
+        if isinstance(part, str):
+            return iter(self.postings.get(part, ()) if live else self.base_postings.get(part, ()))
+        return heapq.merge(*(self._all_of(parts, live) for _, parts in part))
+
+    def _all_of(self, parts, live):
+        first, *rest = sorted(parts, key=self._size)
+        for doc in self._docs(first, live):
+            if all(self._typos(p, doc) is not None for p in rest):
+                yield doc
+
+    def _any(self, parts):
+        return next(itertools.chain(self._all_of(parts, False), self._all_of(parts, True)), None) is not None
+
+    def _term(self, token, prefix):
+        if not prefix and self._known(token):
+            found = [(0, (token,))]
+        else:
+            found = [(0, (t,)) for t in self._prefix_tokens(token)]
+        # "spiderman" also finds captions that say "Spider-Man"
+        for i in range(2, len(token) - 1):
+            if self._known(token[:i]) and self._known(token[i:]) and self._any((token[:i], token[i:])):
+                found.append((0, (token[:i], token[i:])))
+        if found or len(token) < FUZZY_MIN_LEN:
+            return found
+        return [(dist, (word,)) for dist, word in self.similar(token, prefix)]
+
+    def _terms(self, query):
+        # Every word must match, allowing for typos; the last one is a prefix since the
+        # user may still be typing
+        tokens = query_tokens(query)
+        terms = []
+        i = 0
+        while i < len(tokens):
+            last = i == len(tokens) - 1
+            # "spider man" for a caption that says "Spiderman"
+            if not last:
+                joined = tokens[i] + tokens[i + 1]
+                tail = i + 1 == len(tokens) - 1
+                if self._known(joined) or (tail and self._prefix_tokens(joined)):
+                    pair = (self._term(tokens[i], False), self._term(tokens[i + 1], tail))
+                    terms.append([(0, pair)] + self._term(joined, tail))
+                    i += 2
+                    continue
+            terms.append(self._term(tokens[i], last))
+            i += 1
+        return terms
+
+    def matches(self, query, tokens):
+        # Whether `query` finds a caption with these tokens, whether or not it is indexed
+        words = set(tokens)
+        def has(part):
+            if isinstance(part, str):
+                return part in words
+            return any(all(map(has, parts)) for _, parts in part)
+        terms = self._terms(query)
+        return bool(terms) and all(map(has, terms))
+
+    def _hits(self, terms, live):
+        # (doc, total typos) for docs matching every term, in doc order; the smallest
+        # term is walked and the others are checked against it
+        driver = min(terms, key=self._size)
+        rest = [t for t in terms if t is not driver]
+        # Words alone at one distance, typically a prefix's completions: every doc the
+        # driver yields matches it with that many typos, no need to look again
+        if len({dist for dist, _ in driver}) == 1 and all(len(parts) == 1 and isinstance(parts[0], str) for _, parts in driver):
+            fixed = driver[0][0]
+        else:
+            fixed, rest = 0, terms
+        last = None
+        for doc in self._docs(driver, live):
+            if doc == last or doc in self.dead:
+                continue
+            last = doc
+            total = fixed
+            for term in rest:
+                typos = self._typos(term, doc)
+                if typos is None:
+                    break
+                total += typos
+            else:
+                yield doc, total
+
+    def _key(self, doc):
+        # Captions differing only in case or punctuation are the same upload posted twice
+        return " ".join(tokenize(self.record(doc).caption))
+
+    def _distinct(self, docs):
+        seen = set()
+        for doc in docs:
+            key = self._key(doc)
+            if key not in seen:
+                seen.add(key)
+                yield doc
+
+    def find(self, query, offset=0, limit=50):
+        # Fewest typos first, then shorter captions: fewer extra words means a closer
+        # match. Every doc added since the last compaction is checked; base docs are
+        # walked in rank order and the walk stops once `want` distinct captions with
+        # the fewest typos any doc could have are in, since no later doc can beat them.
+        terms = self._terms(query)
+        if not terms:
+            return [], False
+        want = offset + limit + 1
+        hits = dict(self._hits(terms, True))
+        best = sum(map(self._least_typos, terms))
+        seen = {self._key(d) for d, typos in hits.items() if typos == best}
+        enough = 0
+        for doc, typos in self._hits(terms, False):
+            hits[doc] = typos
+            if typos == best:
+                key = self._key(doc)
+                if key not in seen:
+                    seen.add(key)
+                    enough += 1
+                    if enough >= want:
+                        break
+        ranked = sorted(hits, key=lambda d: (hits[d], *self._rank(d)))
+        distinct = list(itertools.islice(self._distinct(ranked), want))
+        return distinct[offset:offset + limit], len(distinct) == want
+
+    def search(self, query, offset=0, limit=50):
+        docs, more = self.find(query, offset, limit)
+        return [self.record(d) for d in docs], more
+
+    def count(self, query, cap):
+        # Matches, stopping at `cap`
+        terms = self._terms(query)
+        if not terms:
+            return 0
+        hits = itertools.chain(self._hits(terms, True), self._hits(terms, False))
+        return sum(1 for _ in itertools.islice(hits, cap))
+
+    def write(self, f, upto, dead, last_id, resume_token):
+        # Compacted snapshot of docs below `upto`; safe to run off the event loop
+        # since docs below `upto` are never modified in place. `last_id` and
+        # `resume_token` are the ones that went with `upto`, not the current ones.
+        docs = sorted((d for d in range(upto) if d not in dead), key=self._rank)
+        records = [self.record(d) for d in docs]
+        postings = {}
+        for doc, r in enumerate(records):
+            for token in set(tokenize(r.caption)):
+                postings.setdefault(token, array("I")).append(doc)
+        tokens = sorted(postings)
+        captions = [r.caption.encode() for r in records]
+        cap_offsets = array("Q", [0])
+        for c in captions:
+            cap_offsets.append(cap_offsets[-1] + len(c))
+        flat = array("I")
+        post_offsets = array("Q", [0])
+        for token in tokens:
+            flat.extend(postings[token])
+            post_offsets.append(len(flat))
+        blob = b"".join(captions)
+        token_blob = "\n".join(tokens).encode()
+        extra = json.dumps({"last_id": last_id, "resume_token": resume_token}).encode()
+        f.write(HEADER.pack(MAGIC, len(records), len(tokens), len(flat), len(blob), len(token_blob), len(extra)))
+        f.write(array("q", (r.chat_id for r in records)).tobytes())
+        f.write(array("q", (r.message_id for r in records)).tobytes())
+        f.write(cap_offsets.tobytes())
+        f.write(post_offsets.tobytes())
+        f.write(flat.tobytes())
+        f.write(b"\0" * (len(flat) % 2 * 4))
+        f.write(blob)
+        f.write(token_blob)
+        f.write(extra)
+
+    def compact(self, path, upto, dead, last_id, resume_token):
+        # A new index holding docs below `upto` as its base, also written to `path`
+        # when given. Runs off the event loop; see rebase() for the docs since.
+        if not path:
+            buf = io.BytesIO()
+            self.write(buf, upto, dead, last_id, resume_token)
+            return self.from_buffer(buf.getbuffer())
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            self.write(f, upto, dead, last_id, resume_token)
+        os.replace(tmp, path)
+        return self.load(path)
+
+    def rebase(self, index, upto, dead):
+        # Takes over `index`, compacted from docs below `upto` with `dead` left out,
+        # after replaying what changed here since: docs removed or replaced below
+        # `upto`, and docs added from `upto` on
+        for doc in self.dead - dead:
+            if doc < upto:
+                r = self.record(doc)
+                index.remove(r.chat_id, r.message_id)
+        for doc in range(upto, self.base + len(self.records)):
+            if doc not in self.dead:
+                r = self.record(doc)
+                index.add(r.chat_id, r.message_id, r.caption)
+        index.last_id = self.last_id
+        index.resume_token = self.resume_token
+        self.replace(index)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index = cls.from_buffer(mm)
+        index._mmap = mm
+        return index
+
+    @classmethod
+    def from_buffer(cls, buf):
+        magic, n_docs, n_tokens, n_postings, blob_len, tokens_len, extra_len = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("not a caption index snapshot")
+        view = memoryview(buf)
+        pos = HEADER.size
+
+        def take(size, fmt=None):
+            nonlocal pos
+            part = view[pos:pos + size]
+            pos += size
+            return part.cast(fmt) if fmt else part
+
+        chat_ids = take(8 * n_docs, "q")
+        message_ids = take(8 * n_docs, "q")
+        cap_offsets = take(8 * (n_docs + 1), "Q")
+        post_offsets = take(8 * (n_tokens + 1), "Q")
+        flat = take(4 * n_postings, "I")
+        take(n_postings % 2 * 4)
+        blob = take(blob_len)
+        tokens = str(take(tokens_len), "utf-8").split("\n") if n_tokens else []
+        extra = json.loads(str(take(extra_len), "utf-8"))
+
+        index = cls()
+        index.base = n_docs
+        index.columns = (chat_ids, message_ids, cap_offsets, blob)
+        index.base_postings = {
+            sys.intern(token): flat[post_offsets[i]:post_offsets[i + 1]] for i, token in enumerate(tokens)
+        }
+        index.vocab = list(index.base_postings)
+        for token in index.vocab:
+            index._add_grams(token)
+        index.last_id = extra["last_id"]
+        index.resume_token = extra["resume_token"]
+        # Built here, off the event loop, rather than on the first update
+        index.slots
+        return index
+
+
+# inline.py
+
+import asyncio
+
+from config import INLINE_DEBOUNCE
+from database import search_files, search_page
+from utils import normalize_query
+
+_latest = {}
+_inflight = {}
+
+async def debounce(key, token, delay=INLINE_DEBOUNCE):
+    # Telegram sends a query per keystroke; only the last one a user typed gets answered.
+    # Page turns use it per results message, keyed by the message.
+    _latest[key] = token
+    await asyncio.sleep(delay)
+    if _latest.get(key) != token:
+        return False
+    del _latest[key]
+    return True
+
+async def _search(query, offset, limit):
+    if offset % limit == 0:
+        # The offsets we hand out are whole pages, so they share the result cache with /search
+        return await search_page(query, offset // limit + 1, limit)
+    files = await search_files(query, skip=offset, limit=limit + 1)
+    return files[:limit], len(files) > limit
+
+async def inline_search(query, offset, limit):
+    # Identical queries already in flight share one search
+    key = (normalize_query(query), offset, limit)
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(_search(query, offset, limit))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await task
+
+
+# handles.py
+
+import base64
+import hashlib
+
+from cache import TTLCache
+from config import HANDLE_CACHE_SIZE, HANDLE_TTL, HANDLE_RESULT_IDS, SEARCH_COUNT_CAP
+from metrics import watch_cache
+from database import search_refs, count_files, get_files, search_page, parse_query, result_cache
+from utils import normalize_query, message_link
+
+# Callback data carries an 8 character handle instead of the query text. The handle
+# only maps back to the normalized query; its result refs live in the result cache,
+# so they are invalidated with it and rebuilt on a miss.
+handle_queries = TTLCache(HANDLE_CACHE_SIZE, HANDLE_TTL)
+watch_cache("handles", handle_queries)
+
+def handle_id(key):
+    return base64.urlsafe_b64encode(hashlib.blake2b(key.encode(), digest_size=6).digest()).decode()
+
+async def load_handle(key):
+    refs = await search_refs(key, HANDLE_RESULT_IDS)
+    total = len(refs) if len(refs) < HANDLE_RESULT_IDS else await count_files(key)
+    return {"query": key, "refs": refs, "total": total}
+
+def query_handle(query):
+    key = normalize_query(query)
+    if not key:
+        return None, None
+    hid = handle_id(key)
+    handle_queries.set(hid, key)
+    return hid, key
+
+async def open_handle(query):
+    hid, key = query_handle(query)
+    if not key:
+        return None, None
+    return hid, await load_handle(key)
+
+async def get_handle(hid):
+    key = handle_queries.get(hid)
+    if key is None:
+        return None
+    return await load_handle(key)
+
+async def handle_page(handle, page, limit):
+    refs = handle["refs"]
+    start = (page - 1) * limit
+    truncated = len(refs) >= HANDLE_RESULT_IDS
+    if start + limit <= len(refs) or not truncated:
+        files = await get_files(refs[start:start + limit])
+        return files, start + limit < len(refs) or truncated
+    # Past the refs kept with the handle, run the search for this page instead
+    return await search_page(handle["query"], page, limit)
+
+def page_label(page, total, limit):
+    if total >= SEARCH_COUNT_CAP:
+        return f"Page {page}"
+    return f"Page {page}/{(total + limit - 1) // limit}"
+
+def render_page(handle, files, page, limit):
+    header = f"🔍 **Results for:** `{handle['query']}` ({page_label(page, handle['total'], limit)})\n\n"
+    return header + "".join(
+        f"{i}. [{f['caption'][:50]}]({message_link(f['chat_id'], f['message_id'])})\n" for i, f in enumerate(files, 1)
+    )
+
+async def page_view(handle, page, limit):
+    # (text, has_next) for a results page, or (None, False) past the end. Rendered once
+    # per (query, page) and cached with the query's result ids, so new files that could
+    # change the page drop it along with them.
+    tokens, found = parse_query(handle["query"])
+    key = ("view", tuple(tokens), page, limit, tuple(sorted(found.items())))
+    view = result_cache.get(key)
+    if view is None:
+        files, has_next = await handle_page(handle, page, limit)
+        if not files:
+            return None, False
+        view = render_page(handle, files, page, limit), has_next
+        result_cache.set(key, view)
+    return view
+
+
+# delivery.py
+
+import asyncio
+import itertools
+
+from pyrogram import raw
+from pyrogram.errors import FloodWait, RPCError
+
+from config import DELIVERY_CONCURRENCY, DELIVERY_RETRIES
+from metrics import inc
+from pool import pool
+
+_slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+_queues = {}
+
+def group_by_source(files):
+    # Neighbouring results from the same chat go out as one request, order preserved
+    for from_chat_id, group in itertools.groupby(files, key=lambda f: f["chat_id"]):
+        message_ids = [f["message_id"] for f in group]
+        for i in range(0, len(message_ids), 100):
+            yield from_chat_id, message_ids[i:i + 100]
+
+async def copy_messages(client, chat_id, from_chat_id, message_ids):
+    if len(message_ids) == 1:
+        return await client.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0])
+    # A forward without the author header arrives like copy_message, but in one round trip
+    await client.invoke(
+        raw.functions.messages.ForwardMessages(
+            from_peer=await client.resolve_peer(from_chat_id),
+            to_peer=await client.resolve_peer(chat_id),
+            id=message_ids,
+            random_id=[client.rnd_id() for _ in message_ids],
+            drop_author=True,
+        )
+    )
+
+async def _send_batch(client, chat_id, from_chat_id, message_ids):
+    for _ in range(DELIVERY_RETRIES):
+        await pool.acquire(client)
+        try:
+            async with _slots:
+                await copy_messages(client, chat_id, from_chat_id, message_ids)
+            return len(message_ids)
+        except FloodWait as e:
+            inc("floodwait_total", where="delivery")
+            # The wait applies to this bot, so its broadcasts back off too
+            pool.pause(client, e.value)
+            await asyncio.sleep(e.value)
+        except RPCError:
+            return 0
+        except Exception:
+            # Dropped connection or timeout; worth another try
+            inc("delivery_errors_total")
+    return 0
+
+def _resolve(done, sent):
+    if not done.done():
+        done.set_result(sent)
+
+async def _drain(client, chat_id, queue):
+    # Whatever happens to a batch, its future resolves and the chat's queue goes away
+    # with this task, so later deliveries to the chat start a fresh one
+    try:
+        while True:
+            try:
+                files, done = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            sent = 0
+            try:
+                for from_chat_id, message_ids in group_by_source(files):
+                    sent += await _send_batch(client, chat_id, from_chat_id, message_ids)
+            finally:
+                _resolve(done, sent)
+    finally:
+        if _queues.get(chat_id) is queue:
+            del _queues[chat_id]
+        while not queue.empty():
+            _resolve(queue.get_nowait()[1], 0)
+
+def deliver(client, chat_id, files):
+    # Queue files for a chat; each chat is drained in order by its own task, while
+    # _slots caps sends across all chats. The future resolves to the number sent.
+    done = asyncio.get_running_loop().create_future()
+    queue = _queues.get(chat_id)
+    if queue is None:
+        queue = _queues[chat_id] = asyncio.Queue()
+        asyncio.create_task(_drain(client, chat_id, queue))
+    queue.put_nowait((files, done))
+    return done
+
+
+# users.py
+
+import asyncio
+
+from pymongo import UpdateOne
+from database import run_sync, users_collection
+
+def _load_known():
+    known, bots = {}, {}
+    for u in users_collection.find({}, {"name": 1, "bots": 1}):
+        known[u["_id"]] = hash(u.get("name"))
+        if u.get("bots", 1) != 1:
+            bots[u["_id"]] = u["bots"]
+    return known, bots
+
+class UserRegistry:
+    # Known ids map to a hash of the stored name, so repeat messages from known
+    # users cost a dict lookup and only new users or renames are written back.
+    # `bots` is the bitmask of pool bots a user has started, kept only when it isn't
+    # just the first bot (users from before multi-bot mode only know that one).
+    def __init__(self):
+        self.known = {}
+        self.bots = {}
+        self.dirty = {}
+
+    async def load(self):
+        self.known, self.bots = await run_sync(_load_known)
+
+    def reach(self, user_id):
+        return self.bots.get(user_id, 1 if user_id in self.known else 0)
+
+    def touch(self, user_id, name, bot=0):
+        # True the first time a user is ever seen
+        name_hash = hash(name)
+        old = self.known.get(user_id)
+        reach = self.reach(user_id)
+        if old == name_hash and reach >> bot & 1:
+            return False
+        self.known[user_id] = name_hash
+        reach |= 1 << bot
+        if reach != 1:
+            self.bots[user_id] = reach
+        self.dirty[user_id] = name
+        return old is None
+
+    def forget(self, user_ids):
+        for user_id in user_ids:
+            self.known.pop(user_id, None)
+            self.bots.pop(user_id, None)
+            self.dirty.pop(user_id, None)
+
+    async def flush(self):
+        if not self.dirty:
+            return 0
+        dirty, self.dirty = self.dirty, {}
+        ops = [
+            UpdateOne({"_id": user_id}, {"$set": {"name": name, "bots": self.reach(user_id)}}, upsert=True)
+            for user_id, name in dirty.items()
+        ]
+        try:
+            await run_sync(users_collection.bulk_write, ops, ordered=False)
+        except Exception:
+            # Keep them for the next flush; a newer name that arrived meanwhile wins
+            for user_id, name in dirty.items():
+                self.dirty.setdefault(user_id, name)
+            raise
+        return len(ops)
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+registry = UserRegistry()
+
+
+# broadcast.py
+
+import asyncio
+import time
+
+from pyrogram.errors import FloodWait, InputUserDeactivated, PeerIdInvalid, RPCError, UserIsBlocked
+
+from config import BROADCAST_WORKERS, BROADCAST_CHUNK, BROADCAST_RETRIES, BROADCAST_PROGRESS_INTERVAL
+from database import get_broadcast, save_broadcast, get_users_after, delete_users, get_total_user_count
+from metrics import inc
+from pool import pool
+from users import registry
+
+async def send_one(user, text):
+    # Through whichever of the user's bots has the most budget left. A bot the user
+    # blocked is skipped; only a user none of them can reach is pruned.
+    mask = user.get("bots", 1) & pool.mask()
+    if not mask:
+        return "failed"
+    for _ in range(BROADCAST_RETRIES):
+        bot = pool.pick(mask)
+        bucket = pool.buckets[bot]
+        await bucket.acquire()
+        try:
+            await pool.clients[bot].send_message(user["_id"], text)
+            return "sent"
+        except FloodWait as e:
+            inc("floodwait_total", where="broadcast")
+            # The next attempt goes to another bot if one has budget, else waits here
+            bucket.pause(e.value)
+        except (UserIsBlocked, InputUserDeactivated, PeerIdInvalid):
+            mask &= ~(1 << bot)
+            if not mask:
+                return "pruned"
+        except RPCError:
+            return "failed"
+        except Exception:
+            # Dropped connection or timeout; worth another try
+            inc("broadcast_errors_total")
+    return "failed"
+
+def progress_text(state, started, processed):
+    done = state["sent"] + state["failed"] + state["pruned"]
+    rate = processed / max(time.monotonic() - started, 1)
+    left = max(state["total"] - done, 0)
+    eta = f"{left / rate / 60:.0f} min" if rate else "?"
+    return (
+        f"📣 **Broadcasting...** {done}/{state['total']}\n\n"
+        f"✅ Sent: `{state['sent']}`\n"
+        f"❌ Failed: `{state['failed']}`\n"
+        f"🗑️ Pruned: `{state['pruned']}`\n"
+        f"⚡ {rate:.1f} msg/s, ETA {eta}"
+    )
+
+async def run_broadcast(client, state):
+    # Users go out in _id order, one chunk at a time; progress is saved after each chunk,
+    # so a crash repeats at most one chunk.
+    started, processed = time.monotonic(), 0
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await client.edit_message_text(state["chat_id"], state["message_id"], progress_text(state, started, processed))
+            except Exception:
+                pass
+
+    reporter = asyncio.create_task(report())
+    try:
+        while True:
+            users = await get_users_after(state["last_id"], BROADCAST_CHUNK)
+            if not users:
+                break
+            queue = asyncio.Queue()
+            for user in users:
+                queue.put_nowait(user)
+            pruned = []
+
+            async def worker():
+                nonlocal processed
+                while not queue.empty():
+                    user = queue.get_nowait()
+                    outcome = await send_one(user, state["text"])
+                    state[outcome] += 1
+                    processed += 1
+                    if outcome == "pruned":
+                        pruned.append(user["_id"])
+
+            # Enough senders to keep every bot's bucket busy
+            await asyncio.gather(*(worker() for _ in range(BROADCAST_WORKERS * max(len(pool.clients), 1))))
+            await delete_users(pruned)
+            registry.forget(pruned)
+            state["last_id"] = users[-1]["_id"]
+            await save_broadcast(last_id=state["last_id"], sent=state["sent"], failed=state["failed"], pruned=state["pruned"])
+    except Exception as e:
+        # Mongo unreachable, say. Finish as stopped rather than leave a broadcast that
+        # looks like it is running until the next restart.
+        inc("broadcast_errors_total")
+        error = f"{type(e).__name__}: {e}"
+    else:
+        error = None
+    finally:
+        reporter.cancel()
+
+    await save_broadcast(done=True, error=error)
+    if error:
+        text = f"⚠️ Broadcast stopped after {state['sent']} users: `{error}`"
+    else:
+        text = f"✅ Broadcast sent to {state['sent']} users."
+    text += f"\n❌ Failed: {state['failed']}\n🗑️ Pruned: {state['pruned']}"
+    try:
+        await client.edit_message_text(state["chat_id"], state["message_id"], text)
+    except RPCError:
+        # The status message is gone; tell the owner in a new one
+        await client.send_message(state["chat_id"], text)
+
+async def start_broadcast(client, text, status):
+    state = {
+        "text": text,
+        "chat_id": status.chat.id,
+        "message_id": status.id,
+        "last_id": 0,
+        "sent": 0,
+        "failed": 0,
+        "pruned": 0,
+        "total": await get_total_user_count(),
+        "done": False,
+        "error": None,
     }
-    files_collection.update_one({"file_id": file_id}, {"$set": data}, upsert=True)
+    await save_broadcast(**state)
+    return asyncio.create_task(run_broadcast(client, state))
+
+async def resume_broadcast(client):
+    state = await get_broadcast()
+    if state:
+        return asyncio.create_task(run_broadcast(client, state))
+
+
+# metrics.py
+
+import asyncio
+import bisect
+import functools
+import time
+from collections import defaultdict
+
+from config import METRICS_LAG_INTERVAL
+
+# Prometheus text format without the client library: counters and histograms keyed by
+# (name, labels), plus the hit/miss counts every TTLCache already keeps.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+counters = defaultdict(float)
+histograms = defaultdict(Histogram)
+caches = {}
+gauges = {}
+loop_lag = {"last": 0.0, "max": 0.0}
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    counters[_key(name, labels)] += value
+
+def observe(name, value, **labels):
+    histograms[_key(name, labels)].observe(value)
+
+def watch_cache(name, cache):
+    caches[name] = cache
+
+def watch_gauge(name, read):
+    # Sampled when /metrics is scraped
+    gauges[name] = read
+
+def timed(name=None):
+    # Latency histogram and error counter for an async handler; goes under @app.on_*
+    def wrap(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                inc("handler_errors_total", handler=label)
+                raise
+            finally:
+                observe("handler_seconds", time.perf_counter() - start, handler=label)
+        return inner
+    return wrap
+
+async def monitor_loop_lag(interval=METRICS_LAG_INTERVAL):
+    # How late a sleep wakes up is how long something else held the loop
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(time.perf_counter() - start - interval, 0.0)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+        observe("loop_lag_seconds", lag)
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+def render():
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f"{name}{_labels(labels)} {value:g}")
+    for (name, labels), h in sorted(histograms.items()):
+        seen = 0
+        for bound, n in zip(BUCKETS + ("+Inf",), h.counts):
+            seen += n
+            lines.append(f"{name}_bucket{_labels(labels, le=bound)} {seen}")
+        lines.append(f"{name}_sum{_labels(labels)} {h.sum:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {h.count}")
+    for name, cache in sorted(caches.items()):
+        stats = cache.stats()
+        for field in ("size", "bytes", "hits", "misses"):
+            lines.append(f'cache_{field}{{cache="{name}"}} {stats[field]}')
+    for name, read in sorted(gauges.items()):
+        lines.append(f"{name} {read():g}")
+    lines.append(f"loop_lag_max_seconds {loop_lag['max']:.6f}")
+    return "\n".join(lines) + "\n"
+
+def summary(top=8):
+    # Short text for /perf: slowest handlers and Mongo calls, caches, FloodWaits, lag
+    def rows(metric, label):
+        found = [(dict(labels)[label], h) for (name, labels), h in histograms.items() if name == metric]
+        found.sort(key=lambda item: item[1].sum, reverse=True)
+        return [
+            f"`{what}` n={h.count} avg={h.sum / h.count * 1000:.0f}ms p50≤{h.quantile(0.5) * 1000:g}ms p99≤{h.quantile(0.99) * 1000:g}ms"
+            for what, h in found[:top]
+        ]
+
+    lines = ["**Handlers:**", *rows("handler_seconds", "handler"), "", "**Mongo:**", *rows("mongo_seconds", "op"), "", "**Caches:**"]
+    for name, cache in sorted(caches.items()):
+        stats = cache.stats()
+        lines.append(f"`{name}` {stats['hit_ratio']:.0%} hits, {stats['size']} entries")
+    errors = sum(v for (name, _), v in counters.items() if name == "handler_errors_total")
+    floods = sum(v for (name, _), v in counters.items() if name == "floodwait_total")
+    lines += [
+        "",
+        f"Errors: {errors:g} · FloodWaits: {floods:g}",
+        *(f"{name}: {read():g}" for name, read in sorted(gauges.items())),
+        f"Loop lag: {loop_lag['last'] * 1000:.1f}ms now, {loop_lag['max'] * 1000:.1f}ms max",
+    ]
+    return "\n".join(lines)
 
-def search_files(query):
-    return list(files_collection.find({"caption": {"$regex": query, "$options": "i"}}))
+async def _respond(reader, writer):
+    try:
+        request = await reader.readline()
+        path = request.split()[1] if len(request.split()) > 1 else b""
+        if path == b"/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    return await asyncio.start_server(_respond, host, port)
+
+
+# jobs.py
+
+import asyncio
+import json
+import multiprocessing
+import zlib
+
+from config import WORKERS, REDIS_URL, WORKER_CONCURRENCY
+from metrics import inc
+from pool import pool
+
+# With WORKERS > 0 the process receiving updates only checks access and enqueues; the
+# work runs in worker processes, each with its own event loop, Mongo pool and caption
+# index. A job goes to the worker picked by a stable hash of its key (the query handle
+# for searches and page turns), so each worker's result cache and handles stay warm for
+# the queries it owns and no cache state has to be shared between processes.
+# Queues are Redis lists when REDIS_URL is set (workers started with
+# `python bot.py --worker N`, on any host), otherwise multiprocessing queues to workers
+# spawned by the bot itself.
+job_handlers = {}
+_queues = []
+_redis = None
+_running = set()
+
+def job(kind):
+    def register(func):
+        job_handlers[kind] = func
+        return func
+    return register
+
+def worker_for(key):
+    return zlib.crc32(str(key).encode()) % WORKERS
+
+def _redis_client():
+    global _redis
+    if _redis is None:
+        import redis.asyncio as redis
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+async def dispatch(client, kind, key, **payload):
+    # Runs the job right here when there are no workers
+    if not WORKERS:
+        return await job_handlers[kind](client, **payload)
+    # Replies have to come from the bot the user talked to
+    body = json.dumps({"kind": kind, "bot": pool.index(client), "payload": payload})
+    index = worker_for(key)
+    if REDIS_URL:
+        await _redis_client().rpush(f"jobs:{index}", body)
+    else:
+        _queues[index].put_nowait(body)
+    inc("jobs_sent_total", kind=kind)
+
+def start_local_workers(target):
+    if REDIS_URL:
+        return []
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(WORKERS):
+        queue = ctx.Queue()
+        _queues.append(queue)
+        process = ctx.Process(target=target, args=(index, queue), name=f"worker{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+async def _next_job(index, queue):
+    if REDIS_URL:
+        _, body = await _redis_client().blpop(f"jobs:{index}")
+        return body
+    return await asyncio.get_running_loop().run_in_executor(None, queue.get)
+
+async def _run(body):
+    job = json.loads(body)
+    try:
+        await job_handlers[job["kind"]](pool.clients[job.get("bot", 0)], **job["payload"])
+    except Exception:
+        inc("job_errors_total", kind=job["kind"])
+
+async def serve_jobs(index, queue=None):
+    # Jobs run concurrently, so a long /indexall or broadcast never holds up searches
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    while True:
+        body = await _next_job(index, queue)
+        await slots.acquire()
+        task = asyncio.create_task(_run(body))
+        _running.add(task)
+        task.add_done_callback(_running.discard)
+        task.add_done_callback(lambda _: slots.release())
+
+
+# ingest.py
+
+import asyncio
+import time
+
+from config import INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_RETRIES
+from database import save_files, edit_files, delete_locations
+from metrics import inc, observe, watch_gauge
+
+class Ingest:
+    # Channel posts, caption edits and deletions are written in batches, once
+    # INGEST_BATCH_SIZE are waiting or INGEST_FLUSH_INTERVAL after the first. The queue
+    # is bounded: in a burst, handlers wait in put() rather than pile up writes.
+    def __init__(self, size=INGEST_QUEUE_SIZE):
+        self.queue = asyncio.Queue(size)
+        self.batch = []
+        self.oldest = None
+
+    async def put(self, op, doc):
+        await self.queue.put((op, doc, time.monotonic()))
+
+    def lag(self):
+        return time.monotonic() - self.oldest if self.oldest else 0.0
+
+    async def _batch(self):
+        # Fills self.batch as items come off the queue, so drain() still has them if
+        # run() is cancelled while waiting for more
+        batch = self.batch
+        batch.append(await self.queue.get())
+        self.oldest = batch[0][2]
+        deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+        while len(batch) < INGEST_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def flush(self, batch):
+        # Last op per message wins. A message is posted before it is edited or deleted,
+        # so saves go first, then edits, then deletes.
+        saves, edits, deletes = {}, {}, set()
+        for op, doc, _ in batch:
+            key = (doc["chat_id"], doc["message_id"])
+            if op == "delete":
+                saves.pop(key, None)
+                edits.pop(key, None)
+                deletes.add(key)
+            elif op == "edit" and key not in saves:
+                edits[key] = doc
+            else:
+                saves[key] = doc
+        await save_files(list(saves.values()), invalidate=True)
+        if edits:
+            await edit_files(list(edits.values()))
+        if deletes:
+            await delete_locations(list(deletes))
+        now = time.monotonic()
+        for op, _, queued in batch:
+            inc("ingest_total", op=op)
+            observe("ingest_lag_seconds", now - queued)
+        inc("ingest_batches_total")
+
+    async def run(self):
+        while True:
+            await self._batch()
+            for attempt in range(INGEST_RETRIES):
+                try:
+                    await self.flush(self.batch)
+                    break
+                except Exception:
+                    inc("ingest_errors_total")
+                    await asyncio.sleep(INGEST_FLUSH_INTERVAL * 2 ** attempt)
+            else:
+                inc("ingest_dropped_total", len(self.batch))
+            self.batch = []
+            self.oldest = None
+
+    async def drain(self):
+        # On shutdown, after updates have stopped and run() was cancelled; a batch it
+        # was collecting or writing is written here, again in the latter case, which the
+        # upserts make harmless
+        if self.batch:
+            await self.flush(self.batch)
+            self.batch = []
+        while not self.queue.empty():
+            batch = []
+            while not self.queue.empty() and len(batch) < INGEST_BATCH_SIZE:
+                batch.append(self.queue.get_nowait())
+            await self.flush(batch)
+
+ingest = Ingest()
+watch_gauge("ingest_queue_depth", ingest.queue.qsize)
+watch_gauge("ingest_lag_seconds_now", ingest.lag)
+
+
+# bench.py
+
+# Offline benchmark: drives the real handlers from bot.py against a stub Telegram client
+# and an in-memory Mongo (pip install mongomock), so search and indexing can be measured
+# without touching Telegram.
+#
+#   python bench.py --files 10000,100000 --ops 500
+#
+# /indexall is timed on the first --index messages; the rest of the catalog is inserted
+# directly, since it only has to exist for the searches.
+#
+# Set BENCH_MONGO_URI to a throwaway local mongod to measure against a real server (and
+# include filtered queries, which mongomock can't run). The bench drops the bot's files,
+# users and meta collections there.
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import resource
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from pyrogram.enums import ChatMemberStatus, ChatType
+
+import config
+
+config.MONGO_URI = os.environ.get("BENCH_MONGO_URI", "mongomock://")
+config.CAPTION_INDEX_PATH = ""
+config.INLINE_DEBOUNCE = 0
+config.PAGE_DEBOUNCE = 0
+config.USER_BURST = 10**9
+config.METRICS_PORT = 0
+config.LOG_CHANNEL = 0
+config.INDEX_CHANNELS = [-1000000000001]
+
+import bot
+from database import files_collection, users_collection, meta_collection, result_cache, caption_index, load_caption_index, file_doc
+from handles import open_handle
+from memindex import CaptionIndex
+from utils import media_meta
+
+SYLLABLES = ("ka", "ri", "to", "men", "dra", "lo", "vi", "sen", "tar", "qu", "el", "on", "ax", "po", "ne", "zu", "bar", "mi")
+QUALITIES = ("480p", "720p", "1080p", "2160p")
+SOURCES = ("WEB-DL", "WEBRip", "BluRay", "HDRip")
+CODECS = ("x264", "x265", "HEVC")
+LANGS = ("Hindi", "English", "Tamil", "Telugu", "Hindi.English")
+MEMORY_OPS = 50
+SEED_BATCH = 5000
+
+class Catalog:
+    # Captions are derived from the message id, so millions of them need no storage
+    def __init__(self, size, seed=1):
+        self.size = size
+        self.seed = seed
+        rng = random.Random(seed)
+        self.words = sorted({"".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(max(size // 20, 500))})
+
+    def release(self, message_id):
+        rng = random.Random(self.seed * 1000003 + message_id)
+        title = rng.choices(self.words, k=rng.randint(1, 4))
+        year = rng.randint(1950, 2024)
+        parts = [".".join(w.title() for w in title), str(year)]
+        if rng.random() < 0.3:
+            parts.append(f"S{rng.randint(1, 9):02d}E{rng.randint(1, 24):02d}")
+        parts += [rng.choice(QUALITIES), rng.choice(SOURCES), rng.choice(CODECS), rng.choice(LANGS)]
+        return title, year, ".".join(parts) + rng.choice((".mkv", ".mp4", ""))
+
+    def message(self, chat_id, message_id):
+        media = SimpleNamespace(
+            file_id=f"file{message_id}", file_unique_id=f"u{message_id}", file_size=message_id * 7919 % 4000000000,
+            mime_type="video/x-matroska",
+        )
+        return SimpleNamespace(
+            id=message_id, caption=self.release(message_id)[2], chat=SimpleNamespace(id=chat_id),
+            document=media, video=None, audio=None,
+        )
 
-def delete_files_by_query(query):
-    return files_collection.delete_many({"caption": {"$regex": query, "$options": "i"}})
+    def queries(self, rng, n, filters):
+        kinds = ["exact", "prefix", "typo"] + (["filter"] if filters else [])
+        found = []
+        for i in range(n):
+            words, year, _ = self.release(rng.randint(1, self.size))
+            kind = kinds[i % len(kinds)]
+            if kind == "exact":
+                query = " ".join(words[:2])
+            elif kind == "prefix":
+                query = " ".join(words[:-1] + [words[-1][:3]])
+            elif kind == "typo":
+                longest = max(words, key=len)
+                cut = len(longest) // 2
+                query = " ".join(w if w != longest else w[:cut] + w[cut + 1:] for w in words)
+            else:
+                query = f"{words[0]} year:{year}"
+            found.append(query)
+        return found
+
+class FakeMessage:
+    def __init__(self, text="", from_user=None, chat_id=0, message_id=1):
+        self.id = message_id
+        self.text = text
+        self.command = text.split()
+        self.from_user = from_user
+        self.chat = SimpleNamespace(id=chat_id, type=ChatType.PRIVATE)
+        self.reply_markup = None
+
+    async def reply(self, text, reply_markup=None, **kwargs):
+        reply = FakeMessage(text, chat_id=self.chat.id)
+        reply.reply_markup = reply_markup
+        return reply
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        self.text = text
+        self.reply_markup = reply_markup
+        return self
+
+    async def delete(self):
+        return True
+
+class FakeClient:
+    def __init__(self, catalog, top):
+        self.catalog = catalog
+        self.top = top
+
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status=ChatMemberStatus.MEMBER)
+
+    async def get_chat_history(self, chat_id, offset_id=0):
+        top = offset_id - 1 if offset_id else self.top
+        for message_id in range(top, 0, -1):
+            yield self.catalog.message(chat_id, message_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return FakeMessage(text, chat_id=chat_id)
+
+    async def get_messages(self, chat_id, message_id):
+        return FakeMessage(chat_id=chat_id, message_id=message_id)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return FakeMessage(text, chat_id=chat_id, message_id=message_id)
+
+    async def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    async def answer_inline_query(self, *args, **kwargs):
+        return True
+
+def user(user_id):
+    return SimpleNamespace(id=user_id, first_name="bench")
+
+async def run_search(client, query, i):
+    await bot.search_handler(client, FakeMessage(f"/search {query}", user(i % 1000 + 1)))
+
+async def run_page(client, query, i):
+    hid, handle = await open_handle(query)
+    if handle is None:
+        return
+    data = f"pg:{hid}:2"
+    cb = SimpleNamespace(
+        id=str(i), data=data, matches=[re.match(r"^pg:([\w-]+):(\d+)$", data)], from_user=user(i % 1000 + 1),
+        message=FakeMessage(),
+    )
+    await bot.pagination_callback(client, cb)
 
-def get_total_file_count():
-    return files_collection.count_documents({})
+async def run_inline(client, query, i):
+    await bot.inline_query_handler(client, SimpleNamespace(id=str(i), query=query, offset="", from_user=user(i % 1000 + 1)))
 
-def save_user(user_id, name):
-    users_collection.update_one({"_id": user_id}, {"$set": {"name": name}}, upsert=True)
+OPERATIONS = {"search": run_search, "page": run_page, "inline": run_inline}
 
-def get_total_user_count():
-    return users_collection.count_documents({})
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def report(size, name, latencies, wall, mem=None):
+    n = len(latencies)
+    line = (
+        f"{size:>9} {name:<8} n={n:<6} p50={percentile(latencies, 0.5) * 1000:8.2f}ms "
+        f"p99={percentile(latencies, 0.99) * 1000:8.2f}ms {n / wall:9.1f}/s"
+    )
+    if mem is not None:
+        line += f" mem/op={mem / 1024:8.1f}KiB"
+    print(line, flush=True)
+
+async def measure(name, func, client, queries):
+    # Timing and memory are separate passes; tracemalloc would skew the latencies
+    latencies = []
+    started = time.perf_counter()
+    for i, query in enumerate(queries):
+        t = time.perf_counter()
+        await func(client, query, i)
+        latencies.append(time.perf_counter() - t)
+    wall = time.perf_counter() - started
+    tracemalloc.start()
+    peaks = []
+    for i, query in enumerate(queries[:MEMORY_OPS]):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await func(client, query, i)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return latencies, wall, sum(peaks) / len(peaks)
+
+def seed_catalog(catalog, chat_id, start, stop):
+    for first in range(start, stop + 1, SEED_BATCH):
+        docs = []
+        for message_id in range(first, min(first + SEED_BATCH, stop + 1)):
+            m = catalog.message(chat_id, message_id)
+            docs.append(file_doc(m.document.file_id, m.caption, m.id, chat_id, media_meta(m.document)))
+        files_collection.insert_many(docs)
+
+async def bench_size(size, ops, indexed, seed):
+    for collection in (files_collection, users_collection, meta_collection):
+        collection.delete_many({})
+    result_cache.clear()
+    caption_index.replace(CaptionIndex())
+    caption_index.ready = False
+    catalog = Catalog(size, seed)
+    indexed = min(indexed, size)
+    client = FakeClient(catalog, indexed)
+
+    owner = FakeMessage("/indexall", user(config.BOT_OWNER_ID))
+    started = time.perf_counter()
+    await bot.index_all_files(client, owner)
+    wall = time.perf_counter() - started
+    print(f"{size:>9} {'index':<8} {indexed / wall:9.1f} files/s  ({indexed} in {wall:.1f}s)", flush=True)
+
+    started = time.perf_counter()
+    seed_catalog(catalog, config.INDEX_CHANNELS[0], indexed + 1, size)
+    print(f"{size:>9} {'seed':<8} {time.perf_counter() - started:9.2f}s", flush=True)
+
+    started = time.perf_counter()
+    await load_caption_index()
+    print(f"{size:>9} {'load':<8} {time.perf_counter() - started:9.2f}s  maxrss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}MiB", flush=True)
+
+    queries = catalog.queries(random.Random(seed), ops, filters=not config.MONGO_URI.startswith("mongomock://"))
+    results = {}
+    for name, func in OPERATIONS.items():
+        latencies, wall, mem = await measure(name, func, client, queries)
+        report(size, name, latencies, wall, mem)
+        results[name] = percentile(latencies, 0.99)
+    return results
+
+async def main(args):
+    failed = False
+    for size in args.files:
+        for name, p99 in (await bench_size(size, args.ops, args.index, args.seed)).items():
+            if args.max_p99 and p99 * 1000 > args.max_p99:
+                print(f"!! {name} p99 {p99 * 1000:.1f}ms over budget {args.max_p99}ms at {size} files")
+                failed = True
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark search and indexing offline")
+    parser.add_argument("--files", type=lambda v: [int(n) for n in v.split(",")], default=[10000], help="catalog sizes, comma separated")
+    parser.add_argument("--ops", type=int, default=500, help="queries per operation")
+    parser.add_argument("--index", type=int, default=1000, help="messages to index through /indexall")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-p99", type=float, default=0, help="fail if any search p99 exceeds this many ms")
+    sys.exit(1 if asyncio.run(main(parser.parse_args())) else 0)
 
 
 # Dockerfile
@@ -79,86 +2887,185 @@ CMD ["python", "bot.py"]
 
 # bot.py
 
-from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery, InlineQueryResultArticle, InputTextMessageContent, CallbackQuery
-from pyrogram.enums import ChatMemberStatus
-from pyrogram.errors import UserNotParticipant
-
-from config import API_ID, API_HASH, BOT_TOKEN, INDEX_CHANNELS, FORCE_CHANNEL, FORCE_GROUP, BOT_OWNER_ID, LOG_CHANNEL
-from database import save_file, search_files, delete_files_by_query, get_total_file_count, save_user, get_total_user_count, files_collection
+import asyncio
+import sys
+
+from pyrogram import Client, filters, idle
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, InlineQuery, InlineQueryResultArticle, InputTextMessageContent, CallbackQuery, ChatMemberUpdated
+from pyrogram.enums import ChatMemberStatus, ChatType
+from pyrogram.errors import MessageNotModified
+
+from config import API_ID, API_HASH, BOT_TOKEN, BOT_TOKENS, INDEX_CHANNELS, FORCE_CHANNEL, FORCE_GROUP, BOT_OWNER_ID, LOG_CHANNEL, INLINE_IS_PERSONAL, HANDLE_CACHE_SIZE, HANDLE_TTL, FORCE_SUB_CACHE_SIZE, FORCE_SUB_TTL, USER_FLUSH_INTERVAL, CAPTION_SNAPSHOT_INTERVAL, METRICS_HOST, METRICS_PORT, WORKERS
+from database import file_doc, backfill_tokens, migrate_releases, preview_delete, delete_files_by_query, get_file_stats, get_total_user_count, get_broadcast, load_caption_index, save_caption_index, run_caption_snapshots, result_cache, run_sync, change_streams
+from cache import TTLCache
+from indexer import index_lease, index_channels, dedup_files, report_progress
+from broadcast import start_broadcast, resume_broadcast
+from pool import pool
+from users import registry
+from settings import FIELDS, settings, parse_value
+from admission import SLOW_DOWN, admit, should_warn, shed
+from handles import open_handle, get_handle, handle_page, page_view, query_handle, handle_queries, handle_id
+from delivery import deliver
+from inline import debounce, inline_search
+from jobs import job, dispatch, serve_jobs, start_local_workers
+from ingest import ingest
+from metrics import timed, watch_cache, summary, serve, monitor_loop_lag
+from utils import media_meta, normalize_query, message_link, parse_filters, tokenize, query_tokens
 import humanize
 
 app = Client("file-search-bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Extra bots get app's handlers when they start, see main()
+bots = [app] + [
+    Client(f"file-search-bot-{i}", api_id=API_ID, api_hash=API_HASH, bot_token=token)
+    for i, token in enumerate(BOT_TOKENS, 1)
+]
+
+member_cache = TTLCache(FORCE_SUB_CACHE_SIZE, FORCE_SUB_TTL)
+watch_cache("members", member_cache)
+settings.on_change("force_sub_ttl", lambda ttl: setattr(member_cache, "ttl", ttl))
+settings.on_change("result_cache_ttl", lambda ttl: setattr(result_cache, "ttl", ttl))
+settings.on_change("broadcast_rate", pool.set_rate)
+# Hash of the page text each results message shows, to skip edits that change nothing
+shown_pages = TTLCache(HANDLE_CACHE_SIZE, HANDLE_TTL)
+join_markup = None
+
+JOINED_STATUSES = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+def reply_to(msg):
+    # Same as Message.reply: quote the command except in private chats
+    return None if msg.chat.type == ChatType.PRIVATE else msg.id
+
+def page_markup(hid, page, has_next):
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton("⏪ Prev", callback_data=f"pg:{hid}:{page-1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ⏩", callback_data=f"pg:{hid}:{page+1}"))
+    return InlineKeyboardMarkup([nav]) if nav else None
 
-user_cache = set()
-
-async def check_force_sub(client, user_id):
+async def is_member(client, chat_id, user_id):
     try:
-        user = await client.get_users(user_id)
-        save_user(user.id, user.first_name)
-        if user_id not in user_cache and LOG_CHANNEL:
-            await client.send_message(LOG_CHANNEL, f"👤 New user: [{user.first_name}](tg://user?id={user.id}) (`{user.id}`)")
-            user_cache.add(user_id)
+        member = await client.get_chat_member(chat_id, user_id)
     except:
-        pass
+        return False
+    return member.status in JOINED_STATUSES
 
-    def join_btn(chat, name):
+async def join_button(client, chat_id, name):
+    try:
+        chat = await client.get_chat(chat_id)
+        if chat.username:
+            return InlineKeyboardButton(name, url=f"https://t.me/{chat.username}"), True
+        invite = chat.invite_link or await client.export_chat_invite_link(chat_id)
+        return InlineKeyboardButton(name, url=invite), True
+    except:
+        return InlineKeyboardButton(name, url="https://t.me"), False
+
+async def join_keyboard(client):
+    global join_markup
+    if join_markup is not None:
+        return join_markup
+    (channel_btn, ok_channel), (group_btn, ok_group) = await asyncio.gather(
+        join_button(client, FORCE_CHANNEL, "📢 Join Channel"),
+        join_button(client, FORCE_GROUP, "👥 Join Group"),
+    )
+    markup = InlineKeyboardMarkup([
+        [channel_btn, group_btn],
+        [InlineKeyboardButton("🔄 Refresh", callback_data="refresh_force")]
+    ])
+    # Only keep the keyboard once both links resolved, placeholders get retried next time
+    if ok_channel and ok_group:
+        join_markup = markup
+    return markup
+
+@timed()
+async def check_force_sub(client, user, fresh=False):
+    if registry.touch(user.id, user.first_name, pool.index(client)) and LOG_CHANNEL:
         try:
-            if chat.username:
-                return InlineKeyboardButton(name, url=f"https://t.me/{chat.username}")
-            invite = client.export_chat_invite_link(chat.id)
-            return InlineKeyboardButton(name, url=invite)
+            await client.send_message(LOG_CHANNEL, f"👤 New user: [{user.first_name}](tg://user?id={user.id}) (`{user.id}`)")
         except:
-            return InlineKeyboardButton(name, url="https://t.me")
+            pass
 
-    try:
-        ch_member = await client.get_chat_member(FORCE_CHANNEL, user_id)
-        if ch_member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            raise UserNotParticipant
-    except:
-        return False, InlineKeyboardMarkup([
-            [join_btn(await client.get_chat(FORCE_CHANNEL), "📢 Join Channel"), join_btn(await client.get_chat(FORCE_GROUP), "👥 Join Group")],
-            [InlineKeyboardButton("🔄 Refresh", callback_data="refresh_force")]
-        ])
+    if fresh:
+        member_cache.pop(user.id)
+    joined = member_cache.get(user.id)
+    if joined is None:
+        in_channel, in_group = await asyncio.gather(
+            is_member(client, FORCE_CHANNEL, user.id),
+            is_member(client, FORCE_GROUP, user.id),
+        )
+        joined = in_channel and in_group
+        member_cache.set(user.id, joined, None if joined else settings.force_sub_negative_ttl)
 
-    try:
-        grp_member = await client.get_chat_member(FORCE_GROUP, user_id)
-        if grp_member.status not in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            raise UserNotParticipant
-    except:
-        return False, InlineKeyboardMarkup([
-            [join_btn(await client.get_chat(FORCE_CHANNEL), "📢 Join Channel"), join_btn(await client.get_chat(FORCE_GROUP), "👥 Join Group")],
-            [InlineKeyboardButton("🔄 Refresh", callback_data="refresh_force")]
-        ])
+    if joined:
+        return True, None
+    return False, await join_keyboard(client)
 
-    return True, None
+@app.on_chat_member_updated(filters.chat([FORCE_CHANNEL, FORCE_GROUP]))
+@timed()
+async def force_sub_member_update(client, update: ChatMemberUpdated):
+    member = update.new_chat_member or update.old_chat_member
+    if member and member.user:
+        member_cache.pop(member.user.id)
 
 @app.on_callback_query(filters.regex("refresh_force"))
+@timed()
 async def refresh_force_sub(client, cb):
-    ok, _ = await check_force_sub(client, cb.from_user.id)
+    ok, _ = await check_force_sub(client, cb.from_user, fresh=True)
     if not ok:
         return await cb.answer("❌ Still not joined.", show_alert=True)
     await cb.message.delete()
     await cb.answer("✅ Verified!")
 
 @app.on_message(filters.command("start"))
+@timed()
 async def start_cmd(client, msg: Message):
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use the bot.", reply_markup=kb)
     param = msg.command[1] if len(msg.command) > 1 else ""
     if param.startswith("send_"):
         _, chat_id, message_id = param.split("_")
-        try:
-            await client.copy_message(chat_id=msg.chat.id, from_chat_id=int(chat_id), message_id=int(message_id))
-        except:
+        if not await deliver(client, msg.chat.id, [{"chat_id": int(chat_id), "message_id": int(message_id)}]):
             await msg.reply("❌ Failed to send file.")
         return
     await msg.reply("👋 Welcome! Use /search <query> to begin.")
 
+# Searches, page turns, inline answers, /indexall and broadcasts are jobs: the handlers
+# check access and dispatch them, to a worker process when WORKERS is set (see jobs.py)
+
+async def search_busy(client, chat_id, query, reply_to=None):
+    await client.send_message(chat_id, SLOW_DOWN, reply_to_message_id=reply_to)
+
+@job("search")
+@timed()
+@shed("search", search_busy)
+async def search_job(client, chat_id, query, reply_to=None):
+    page = 1
+    limit = settings.page_size
+    hid, handle = await open_handle(query)
+    if not handle or not handle["refs"]:
+        return await client.send_message(chat_id, "No results found.", reply_to_message_id=reply_to)
+
+    if settings.send_files:
+        results, _ = await handle_page(handle, page, limit)
+        deliver(client, chat_id, results)
+        return
+
+    text, has_next = await page_view(handle, page, limit)
+    sent = await client.send_message(
+        chat_id, text, reply_to_message_id=reply_to,
+        reply_markup=page_markup(hid, page, has_next), disable_web_page_preview=True,
+    )
+    shown_pages.set((chat_id, sent.id), hash(text))
+
 @app.on_message(filters.command("search"))
+@timed()
 async def search_handler(client, msg: Message):
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    if not admit(msg.from_user.id, "search"):
+        if should_warn(msg.from_user.id):
+            await msg.reply(SLOW_DOWN)
+        return
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use this bot.", reply_markup=kb)
 
@@ -166,120 +3073,190 @@ async def search_handler(client, msg: Message):
     if len(parts) < 2:
         return await msg.reply("Usage: /search <query>")
 
-    query = parts[1]
-    page = 1
-    limit = 5
-    files = search_files(query)
-    total = len(files)
-    total_pages = (total + limit - 1) // limit
-    results = files[(page - 1) * limit : page * limit]
-
-    if not results:
-        return await msg.reply("No results found.")
-
-    from config import SEND_FILE_INSTEAD_OF_LINK
-    if SEND_FILE_INSTEAD_OF_LINK:
-        for f in results:
-            try:
-                await client.copy_message(chat_id=msg.chat.id, from_chat_id=f['chat_id'], message_id=f['message_id'])
-            except:
-                pass
-        return
-
-    text = f"🔍 **Results for:** `{query}` (Page {page}/{total_pages})\n\n"
-    for i, file in enumerate(results, 1):
-        link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
-        text += f"{i}. [{file['caption'][:50]}]({link})\n"
-
-    buttons = []
-    if total_pages > 1:
-        buttons.append([InlineKeyboardButton("Next ⏩", callback_data=f"page_{query}_2")])
-
-    await msg.reply(text, reply_markup=InlineKeyboardMarkup(buttons) if buttons else None, disable_web_page_preview=True)
+    # Keyed by the handle its page turns will carry, so they reach the same worker
+    key = handle_id(normalize_query(parts[1]))
+    await dispatch(client, "search", key, chat_id=msg.chat.id, query=parts[1], reply_to=reply_to(msg))
+
+async def page_busy(client, chat_id, message_id, callback_id, user_id, hid, p):
+    await client.answer_callback_query(callback_id, SLOW_DOWN)
+
+@job("page")
+@timed()
+@shed("page", page_busy)
+async def page_job(client, chat_id, message_id, callback_id, user_id, hid, p):
+    limit = settings.page_size
+    handle = await get_handle(hid)
+    if handle is None:
+        return await client.answer_callback_query(callback_id, "⌛ This search has expired, please search again.", show_alert=True)
+
+    if settings.send_files:
+        results, _ = await handle_page(handle, p, limit)
+        if not results:
+            return await client.answer_callback_query(callback_id, "No more results.")
+        await client.delete_messages(chat_id, message_id)
+        deliver(client, user_id, results)
+        return await client.answer_callback_query(callback_id, "✅ Files sent via bot.")
+
+    text, has_next = await page_view(handle, p, limit)
+    if text is None:
+        return await client.answer_callback_query(callback_id, "No more results.")
+    # A tap on what is already shown (a double tap that missed the debounce) costs nothing
+    if shown_pages.get((chat_id, message_id)) != hash(text):
+        try:
+            await client.edit_message_text(
+                chat_id, message_id, text,
+                reply_markup=page_markup(hid, p, has_next), disable_web_page_preview=True,
+            )
+        except MessageNotModified:
+            pass
+        shown_pages.set((chat_id, message_id), hash(text))
+    await client.answer_callback_query(callback_id)
 
-@app.on_callback_query(filters.regex(r"^page_(.+)_(\d+)$"))
+@app.on_callback_query(filters.regex(r"^pg:([\w-]+):(\d+)$"))
+@timed()
 async def pagination_callback(client, query: CallbackQuery):
-    from config import SEND_FILE_INSTEAD_OF_LINK
-    q, p = query.matches[0].group(1), int(query.matches[0].group(2))
-    files = search_files(q)
-    limit = 5
-    total = len(files)
-    total_pages = (total + limit - 1) // limit
-    results = files[(p - 1) * limit : p * limit]
-    if not results:
-        return await query.answer("No more results.")
-
-    if SEND_FILE_INSTEAD_OF_LINK:
-        await query.message.delete()
-        for f in results:
-            try:
-                await client.copy_message(chat_id=query.from_user.id, from_chat_id=f['chat_id'], message_id=f['message_id'])
-            except:
-                pass
-        return await query.answer("✅ Files sent via bot.")
-
-    text = f"🔍 **Results for:** `{q}` (Page {p}/{total_pages})\n\n"
-    for i, file in enumerate(results, 1):
-        link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
-        text += f"{i}. [{file['caption'][:50]}]({link})\n"
-
-    buttons = []
-    nav = []
-    if p > 1:
-        nav.append(InlineKeyboardButton("⏪ Prev", callback_data=f"page_{q}_{p-1}"))
-    if p < total_pages:
-        nav.append(InlineKeyboardButton("Next ⏩", callback_data=f"page_{q}_{p+1}"))
-    if nav:
-        buttons.append(nav)
-
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons) if buttons else None, disable_web_page_preview=True)
-    await query.answer()
+    hid, p = query.matches[0].group(1), int(query.matches[0].group(2))
+    if not admit(query.from_user.id, "page"):
+        return await query.answer(SLOW_DOWN)
+    # Taps on one message that land within page_debounce of each other: only the last
+    # one turns the page
+    if not await debounce(("page", query.message.chat.id, query.message.id), query.id, settings.page_debounce):
+        return await query.answer()
+    await dispatch(
+        client, "page", hid, chat_id=query.message.chat.id, message_id=query.message.id,
+        callback_id=query.id, user_id=query.from_user.id, hid=hid, p=p,
+    )
 
 @app.on_message(filters.command("indexall"))
+@timed()
 async def index_all_files(client, msg: Message):
     if msg.from_user.id != BOT_OWNER_ID:
         return await msg.reply("❌ Only the bot owner can use this command.")
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels.", reply_markup=kb)
 
-    await msg.reply("📦 Indexing started...")
-    total = 0
-    for channel_id in INDEX_CHANNELS:
-        async for m in client.get_chat_history(channel_id, limit=0):
-            media = m.document or m.video or m.audio
-            if media:
-                save_file(media.file_id, m.caption, m.id, m.chat.id)
-                total += 1
-    await msg.reply(f"✅ Indexed {total} files.")
+    status = await msg.reply("📦 Indexing started...")
+    await dispatch(client, "index", "index", chat_id=status.chat.id, status_id=status.id)
+
+@job("index")
+@timed()
+async def index_job(client, chat_id, status_id):
+    status = await client.get_messages(chat_id, status_id)
+    async with index_lease() as held:
+        if not held:
+            return await status.edit_text("⏳ Indexing is already running.")
+        await backfill_tokens()
+        total, errors = await index_channels(client, INDEX_CHANNELS, status)
+
+    text = f"✅ Indexed {total} files."
+    for chat_id, err in errors.items():
+        text += f"\n⚠️ `{chat_id}` stopped early: `{err}` (run /indexall again to resume)"
+    await status.edit_text(text)
+
+@app.on_message(filters.command("dedup"))
+@timed()
+async def dedup_handler(client, msg: Message):
+    if msg.from_user.id != BOT_OWNER_ID:
+        return await msg.reply("❌ Only the bot owner can use this command.")
+
+    async with index_lease() as held:
+        if not held:
+            return await msg.reply("⏳ Indexing is already running.")
+        status = await msg.reply("🧹 Deduplicating...")
+        progress = await dedup_files(client, status)
+    await status.edit_text(f"✅ Checked {progress['checked']} old files, removed {progress['removed']} duplicates.")
+
+@app.on_message(filters.command("delete"))
+@timed()
+async def delete_handler(client, msg: Message):
+    if msg.from_user.id != BOT_OWNER_ID:
+        return await msg.reply("❌ Only the bot owner can use this command.")
+
+    parts = msg.text.split(maxsplit=1)
+    hid, key = query_handle(parts[1]) if len(parts) > 1 else (None, None)
+    if not key:
+        return await msg.reply("Usage: /delete <query>")
+    # Searches leave out release words so a pasted file name still finds the title;
+    # here that would delete every release, so ask for them as filters instead
+    words = tokenize(parse_filters(parts[1])[0])
+    dropped = [w for w in words if w not in query_tokens(" ".join(words))]
+    if dropped:
+        return await msg.reply(
+            f"⚠️ /delete matches title words only and would ignore `{' '.join(dropped)}`, "
+            "widening it to every release. Use filters instead, e.g. `/delete dune q:1080p year:2021`."
+        )
+    total, captions = await preview_delete(key)
+    if not total:
+        return await msg.reply("No matching files.")
+
+    text = f"🗑 **{total}** files match `{key}`:\n\n" + "\n".join(f"• {c[:50]}" for c in captions)
+    if total > len(captions):
+        text += "\n…"
+    buttons = [[
+        InlineKeyboardButton(f"🗑 Delete {total}", callback_data=f"del:{hid}"),
+        InlineKeyboardButton("Cancel", callback_data="del:cancel"),
+    ]]
+    await msg.reply(text, reply_markup=InlineKeyboardMarkup(buttons))
+
+@app.on_callback_query(filters.regex(r"^del:([\w-]+)$"))
+@timed()
+async def delete_callback(client, query: CallbackQuery):
+    if query.from_user.id != BOT_OWNER_ID:
+        return await query.answer("❌ Only the bot owner can do this.", show_alert=True)
+    hid = query.matches[0].group(1)
+    if hid == "cancel":
+        return await query.message.edit_text("Cancelled.")
+    key = handle_queries.get(hid)
+    if key is None:
+        return await query.answer("⌛ This preview has expired, run /delete again.", show_alert=True)
+    progress = {"deleted": 0}
+    async with index_lease() as held:
+        if not held:
+            return await query.answer("⏳ Indexing is running, try again when it finishes.", show_alert=True)
+        await query.answer()
+        await query.message.edit_text(f"🗑 Deleting `{key}`...")
+        reporter = asyncio.create_task(report_progress(
+            query.message, lambda: f"🗑 Deleting `{key}`... {progress['deleted']} removed"
+        ))
+        try:
+            deleted = await delete_files_by_query(key, progress)
+        finally:
+            reporter.cancel()
+    await query.message.edit_text(f"✅ Deleted {deleted} files matching `{key}`.")
 
 @app.on_message(filters.command("stats"))
+@timed()
 async def stats_handler(client, msg: Message):
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels.", reply_markup=kb)
 
-    total_files = get_total_file_count()
-    total_users = get_total_user_count()
+    file_stats, total_users = await asyncio.gather(get_file_stats(), get_total_user_count())
 
-    total_size = 0
-    for f in files_collection.find({}, {"_id": 0, "file_id": 1, "chat_id": 1, "message_id": 1}):
-        try:
-            file = await client.get_messages(f['chat_id'], f['message_id'])
-            media = file.document or file.video or file.audio
-            if media and media.file_size:
-                total_size += media.file_size
-        except:
-            pass
-
-    await msg.reply(
+    text = (
         f"📊 **Bot Statistics:**\n\n"
         f"👥 Total Users: `{total_users}`\n"
-        f"📁 Total Files: `{total_files}`\n"
-        f"💾 Storage Used: `{humanize.naturalsize(total_size)}`"
+        f"📁 Total Files: `{file_stats['files']}`\n"
+        f"💾 Storage Used: `{humanize.naturalsize(file_stats['size'])}`"
     )
+    if msg.from_user.id == BOT_OWNER_ID:
+        cs = result_cache.stats()
+        text += (
+            f"\n🗃️ Result Cache: `{cs['size']}` entries, `{humanize.naturalsize(cs['bytes'])}`, "
+            f"hits `{cs['hits']}` / misses `{cs['misses']}` (`{cs['hit_ratio']:.0%}`)"
+        )
+    await msg.reply(text)
+
+@app.on_message(filters.command("perf"))
+@timed()
+async def perf_handler(client, msg: Message):
+    if msg.from_user.id != BOT_OWNER_ID:
+        return await msg.reply("❌ Only the bot owner can use this command.")
+    await msg.reply("⏱ **Performance**\n\n" + summary())
 
 @app.on_message(filters.command("broadcast") & filters.private)
+@timed()
 async def broadcast_handler(client, msg: Message):
     if msg.from_user.id != BOT_OWNER_ID:
         return await msg.reply("❌ Only the bot owner can broadcast.")
@@ -287,36 +3264,64 @@ async def broadcast_handler(client, msg: Message):
     if len(msg.command) < 2:
         return await msg.reply("Usage: /broadcast <message>")
 
+    if await get_broadcast():
+        return await msg.reply("⏳ A broadcast is already running.")
+
     text = msg.text.split(None, 1)[1]
-    users = users_collection.find({})
-    success, failed = 0, 0
+    status = await msg.reply("📣 Broadcast started...")
+    await dispatch(client, "broadcast", "broadcast", text=text, chat_id=status.chat.id, status_id=status.id)
 
-    for user in users:
-        try:
-            await client.send_message(user["_id"], text)
-            success += 1
-        except:
-            failed += 1
+@job("broadcast")
+@timed()
+async def broadcast_job(client, text, chat_id, status_id):
+    await start_broadcast(client, text, await client.get_messages(chat_id, status_id))
 
-    await msg.reply(f"✅ Broadcast sent to {success} users.\n❌ Failed: {failed}")
+@job("resume_broadcast")
+async def resume_broadcast_job(client):
+    # Picks up a broadcast that was interrupted by a crash or redeploy
+    await resume_broadcast(client)
 
 @app.on_inline_query()
+@timed()
 async def inline_query_handler(client, inline_query: InlineQuery):
-    from config import SEND_FILE_INSTEAD_OF_LINK
-    ok, _ = await check_force_sub(client, inline_query.from_user.id)
+    if not await debounce(inline_query.from_user.id, inline_query.id, settings.inline_debounce):
+        return
+    if not admit(inline_query.from_user.id, "inline"):
+        if should_warn(inline_query.from_user.id):
+            await inline_busy(client, inline_query.id)
+        return
+    ok, _ = await check_force_sub(client, inline_query.from_user)
     if not ok:
         return await client.answer_inline_query(
             inline_query.id,
             results=[],
+            cache_time=0,
+            is_personal=True,
             switch_pm_text="🔐 Join required channel & group",
             switch_pm_parameter="force_sub"
         )
 
     query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    await dispatch(client, "inline", normalize_query(query), query_id=inline_query.id, query=query, offset=offset)
+
+async def inline_busy(client, query_id, query=None, offset=0):
+    await client.answer_inline_query(
+        query_id, results=[], cache_time=0, is_personal=True,
+        switch_pm_text=SLOW_DOWN, switch_pm_parameter="slow_down",
+    )
+
+@job("inline")
+@timed()
+@shed("inline", inline_busy)
+async def inline_job(client, query_id, query, offset):
     results = []
+    next_offset = ""
     if query:
-        files = search_files(query)[:10]
-        if SEND_FILE_INSTEAD_OF_LINK:
+        files, more = await inline_search(query, offset, settings.inline_page_size)
+        if more:
+            next_offset = str(offset + settings.inline_page_size)
+        if settings.send_files:
             for file in files:
                 # This will just send a button that triggers deep link for /start
                 results.append(
@@ -330,7 +3335,7 @@ async def inline_query_handler(client, inline_query: InlineQuery):
                 )
         else:
             for file in files:
-                link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
+                link = message_link(file['chat_id'], file['message_id'])
                 title = file['caption'][:60] if file['caption'] else "Unnamed"
                 results.append(
                     InlineQueryResultArticle(
@@ -339,18 +3344,44 @@ async def inline_query_handler(client, inline_query: InlineQuery):
                         description="Click to view",
                     )
                 )
-    await client.answer_inline_query(inline_query.id, results, cache_time=1)
+    await client.answer_inline_query(
+        query_id,
+        results,
+        cache_time=settings.inline_cache_time,
+        is_personal=INLINE_IS_PERSONAL,
+        next_offset=next_offset,
+    )
+
+def channel_file(msg):
+    media = msg.document or msg.video or msg.audio
+    if media and msg.chat.id in INDEX_CHANNELS:
+        return file_doc(media.file_id, msg.caption, msg.id, msg.chat.id, media_meta(media))
 
 @app.on_message(filters.channel & (filters.document | filters.video | filters.audio))
+@timed()
 async def auto_index_file(client, msg: Message):
-    if msg.chat.id in INDEX_CHANNELS:
-        media = msg.document or msg.video or msg.audio
-        if media:
-            save_file(media.file_id, msg.caption, msg.id, msg.chat.id)
+    doc = channel_file(msg)
+    if doc:
+        await ingest.put("save", doc)
+
+@app.on_edited_message(filters.channel & (filters.document | filters.video | filters.audio))
+@timed()
+async def reindex_edited_file(client, msg: Message):
+    doc = channel_file(msg)
+    if doc:
+        await ingest.put("edit", doc)
+
+@app.on_deleted_messages()
+@timed()
+async def unindex_deleted_files(client, messages):
+    for msg in messages:
+        if msg.chat and msg.chat.id in INDEX_CHANNELS:
+            await ingest.put("delete", {"chat_id": msg.chat.id, "message_id": msg.id})
 
 @app.on_message(filters.command("help"))
+@timed()
 async def help_cmd(client, msg: Message):
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use the bot.", reply_markup=kb)
 
@@ -359,19 +3390,27 @@ async def help_cmd(client, msg: Message):
         "/start - Show welcome message\n"
         "/help - Show this help menu\n"
         "/search <query> - Search for files\n"
+        "  filters: `year:2021` `q:1080p` `lang:hindi` `codec:x265` `s:1` `e:4`\n"
         "/stats - Show bot statistics\n\n"
         "**🔐 Admin Commands:**\n"
         "/indexall - Re-index all files from channels\n"
+        "/dedup - Merge files posted more than once\n"
+        "/delete <query> - Delete matching files, after a preview\n"
+        "/perf - Handler, Mongo and cache timings\n"
+        "/settings, /set <name> <value> - View or change runtime settings\n"
         "/broadcast <text> - Send message to all users\n\n"
         "**🔎 Inline Mode:**\n"
         "Type `@YourBotName query` in any chat to search inline."
     )
     await msg.reply(text, disable_web_page_preview=True)
 
+def settings_text():
+    return "\n".join(f"`{name}` = `{value}`" for name, value in settings.items())
+
 @app.on_message(filters.command("settings"))
+@timed()
 async def settings_cmd(client, msg: Message):
-    from config import SEND_FILE_INSTEAD_OF_LINK
-    ok, kb = await check_force_sub(client, msg.from_user.id)
+    ok, kb = await check_force_sub(client, msg.from_user)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use the bot.", reply_markup=kb)
 
@@ -382,56 +3421,144 @@ async def settings_cmd(client, msg: Message):
         f"**⚙️ Bot Settings:**\n\n"
         f"🔗 Force Channel: `{FORCE_CHANNEL}`\n"
         f"👥 Force Group: `{FORCE_GROUP}`\n"
-        f"📤 Send File Instead of Link: `{SEND_FILE_INSTEAD_OF_LINK}`\n"
-        f"📚 Indexed Channels: `{INDEX_CHANNELS}`\n"
+        f"📚 Indexed Channels: `{INDEX_CHANNELS}`\n\n"
+        f"{settings_text()}\n\n"
+        "Change with /set <name> <value>, or /set <name> default"
     )
 
-@app.on_message(filters.command("admin"))
-async def admin_cmd(client, msg: Message):
+@app.on_message(filters.command("set"))
+@timed()
+async def set_cmd(client, msg: Message):
     if msg.from_user.id != BOT_OWNER_ID:
-        return await msg.reply("❌ Only the bot owner can access this panel.")
+        return await msg.reply("❌ Only the bot owner can change settings.")
+
+    parts = msg.text.split()
+    if len(parts) != 3 or parts[1] not in FIELDS:
+        return await msg.reply("Usage: /set <name> <value|default>\n\n" + settings_text())
+    name, text = parts[1], parts[2]
+    if text == "default":
+        await settings.reset(name)
+    else:
+        try:
+            value = parse_value(name, text)
+        except ValueError:
+            return await msg.reply(f"❌ Bad value for `{name}`: `{text}`")
+        await settings.set(name, value)
+    await msg.reply(f"✅ `{name}` = `{getattr(settings, name)}`")
 
+def admin_panel():
     text = (
         "**🛠️ Admin Panel**\n\n"
         f"🔗 Force Channel: `{FORCE_CHANNEL}`\n"
         f"👥 Force Group: `{FORCE_GROUP}`\n"
-        f"📤 Send File Mode: `{SEND_FILE_INSTEAD_OF_LINK}`\n"
+        f"📤 Send File Mode: `{settings.send_files}`\n"
     )
     buttons = [
         [InlineKeyboardButton("🔁 Toggle Send Mode", callback_data="toggle_send_mode")],
-        [InlineKeyboardButton("🔄 Reload Config", callback_data="reload_config")]
+        [InlineKeyboardButton("🔄 Reload Settings", callback_data="reload_config")]
     ]
-    await msg.reply(text, reply_markup=InlineKeyboardMarkup(buttons))
+    return text, InlineKeyboardMarkup(buttons)
+
+@app.on_message(filters.command("admin"))
+@timed()
+async def admin_cmd(client, msg: Message):
+    if msg.from_user.id != BOT_OWNER_ID:
+        return await msg.reply("❌ Only the bot owner can access this panel.")
+
+    text, markup = admin_panel()
+    await msg.reply(text, reply_markup=markup)
 
 @app.on_callback_query(filters.regex("toggle_send_mode"))
+@timed()
 async def toggle_send_mode(client, cb: CallbackQuery):
     if cb.from_user.id != BOT_OWNER_ID:
         return await cb.answer("Unauthorized", show_alert=True)
 
-    new_state = not cfg.SEND_FILE_INSTEAD_OF_LINK
-    with open("config.py", "r") as f:
-        content = f.read()
-    content = content.replace(
-        f"SEND_FILE_INSTEAD_OF_LINK = {cfg.SEND_FILE_INSTEAD_OF_LINK}",
-        f"SEND_FILE_INSTEAD_OF_LINK = {new_state}"
-    )
-    with open("config.py", "w") as f:
-        f.write(content)
-    cfg.SEND_FILE_INSTEAD_OF_LINK = new_state
-    await cb.answer("Toggled send mode.", show_alert=True)
-    await cb.message.edit_text("✅ Send mode toggled. Please restart the bot to apply changes.")
+    await settings.set("send_files", not settings.send_files)
+    await cb.answer(f"📤 Send File Mode: {settings.send_files}")
+    text, markup = admin_panel()
+    await cb.message.edit_text(text, reply_markup=markup)
 
 @app.on_callback_query(filters.regex("reload_config"))
+@timed()
 async def reload_config(client, cb: CallbackQuery):
     if cb.from_user.id != BOT_OWNER_ID:
         return await cb.answer("Unauthorized", show_alert=True)
 
-    import importlib
-    importlib.reload(cfg)
-    await cb.answer("🔄 Config reloaded.", show_alert=True)
-    await cb.message.edit_text("✅ Configuration reloaded successfully.")
+    # Picks up changes made directly in Mongo; /set applies without this
+    await settings.load()
+    await cb.answer("🔄 Settings reloaded.")
+    text, markup = admin_panel()
+    try:
+        await cb.message.edit_text(text, reply_markup=markup)
+    except MessageNotModified:
+        pass
+
+async def main():
+    if WORKERS and not await run_sync(change_streams):
+        sys.exit("WORKERS needs MongoDB change streams (a replica set) to keep the workers' indexes current")
+    await registry.load()
+    await settings.load()
+    await app.start()
+    for client in bots[1:]:
+        pool.share_handlers(app, client)
+    await asyncio.gather(*(client.start() for client in bots[1:]))
+    for client in bots:
+        pool.add(client, settings.broadcast_rate)
+    tasks = [
+        asyncio.create_task(settings.run()),
+        asyncio.create_task(registry.run(USER_FLUSH_INTERVAL)),
+        asyncio.create_task(monitor_loop_lag()),
+        asyncio.create_task(ingest.run()),
+        asyncio.create_task(migrate_releases()),
+    ]
+    server = await serve(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    if WORKERS:
+        start_local_workers(worker_process)
+    else:
+        # Searches go to Mongo until the caption index has loaded
+        asyncio.create_task(load_caption_index())
+        tasks.append(asyncio.create_task(run_caption_snapshots(CAPTION_SNAPSHOT_INTERVAL)))
+    await dispatch(app, "resume_broadcast", "broadcast")
+    await idle()
+    for task in tasks:
+        task.cancel()
+    if server:
+        server.close()
+    await asyncio.gather(*(client.stop() for client in bots))
+    await ingest.drain()
+    await registry.flush()
+    if not WORKERS:
+        await save_caption_index()
+
+async def worker_main(clients, index, queue=None):
+    await settings.load()
+    for client in clients:
+        await client.start()
+        pool.add(client, settings.broadcast_rate)
+    asyncio.create_task(settings.run())
+    asyncio.create_task(load_caption_index())
+    asyncio.create_task(monitor_loop_lag())
+    # One writer for the shared snapshot file; the others only compact
+    asyncio.create_task(run_caption_snapshots(CAPTION_SNAPSHOT_INTERVAL, write=index == 0))
+    if METRICS_PORT:
+        await serve(METRICS_HOST, METRICS_PORT + 1 + index)
+    await serve_jobs(index, queue)
+
+def worker_process(index, queue=None):
+    # The same bot tokens, in the same order, with sessions of their own; updates keep
+    # going to the main process only
+    clients = [
+        Client(f"worker{index}-{i}", api_id=API_ID, api_hash=API_HASH, bot_token=token, in_memory=True, no_updates=True)
+        for i, token in enumerate([BOT_TOKEN] + BOT_TOKENS)
+    ]
+    clients[0].run(worker_main(clients, index, queue))
 
-app.run()
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--worker"]:
+        worker_process(int(sys.argv[2]))
+    else:
+        app.run(main())
 
 
 # bot.py
@@ -439,29 +3566,50 @@ app.run()
 # Main file for Telegram file search bot
 # Contains all command handlers, inline support, and admin panel.
 
-from pyrogram import Client, filters
+import asyncio
+
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InlineQuery, InlineQueryResultArticle, InputTextMessageContent
 from config import *
 from database import *
+from users import registry
+from settings import settings
+from admission import SLOW_DOWN, admit, should_warn, shed
+from handles import open_handle, get_handle, handle_page, page_view
+from delivery import deliver
+from inline import debounce, inline_search
+from metrics import timed, serve, monitor_loop_lag
+from utils import message_link
+from pyrogram.errors import MessageNotModified
 import humanize
-import importlib
 
 app = Client("file-search-bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
+def page_markup(hid, page, has_next):
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton("⏪ Prev", callback_data=f"pg:{hid}:{page-1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ⏩", callback_data=f"pg:{hid}:{page+1}"))
+    return InlineKeyboardMarkup([nav]) if nav else None
+
 @app.on_message(filters.private & filters.incoming)
+@timed()
 async def log_users(client, msg: Message):
-    save_user(msg.from_user.id, msg.from_user.first_name)
+    registry.touch(msg.from_user.id, msg.from_user.first_name)
 
+@timed()
 async def check_force_sub(client, user_id):
     try:
         await client.get_chat_member(FORCE_CHANNEL, user_id)
         await client.get_chat_member(FORCE_GROUP, user_id)
         return True, None
     except:
-        btn = [[InlineKeyboardButton("📢 Join Channel", url=f"https://t.me/c/{str(FORCE_CHANNEL)[4:]}/1")], [InlineKeyboardButton("💬 Join Group", url=f"https://t.me/c/{str(FORCE_GROUP)[4:]}/1")]]
+        btn = [[InlineKeyboardButton("📢 Join Channel", url=message_link(FORCE_CHANNEL, 1))], [InlineKeyboardButton("💬 Join Group", url=message_link(FORCE_GROUP, 1))]]
         return False, InlineKeyboardMarkup(btn)
 
 @app.on_message(filters.command("start"))
+@timed()
 async def start_cmd(client, msg: Message):
     ok, kb = await check_force_sub(client, msg.from_user.id)
     if not ok:
@@ -470,15 +3618,22 @@ async def start_cmd(client, msg: Message):
     param = msg.command[1] if len(msg.command) > 1 else ""
     if param.startswith("send_"):
         _, chat_id, message_id = param.split("_")
-        try:
-            await client.copy_message(chat_id=msg.chat.id, from_chat_id=int(chat_id), message_id=int(message_id))
-        except:
+        if not await deliver(client, msg.chat.id, [{"chat_id": int(chat_id), "message_id": int(message_id)}]):
             await msg.reply("❌ Failed to send file.")
         return
     await msg.reply("👋 Welcome! Use /search <query> to find files.")
 
+async def search_busy(client, msg):
+    await msg.reply(SLOW_DOWN)
+
 @app.on_message(filters.command("search"))
+@timed()
+@shed("search", search_busy)
 async def search_handler(client, msg: Message):
+    if not admit(msg.from_user.id, "search"):
+        if should_warn(msg.from_user.id):
+            await msg.reply(SLOW_DOWN)
+        return
     ok, kb = await check_force_sub(client, msg.from_user.id)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use this bot.", reply_markup=kb)
@@ -487,90 +3642,89 @@ async def search_handler(client, msg: Message):
     if len(parts) < 2:
         return await msg.reply("Usage: /search <query>")
 
-    query = parts[1]
     page = 1
-    limit = 5
-    files = search_files(query)
-    total = len(files)
-    total_pages = (total + limit - 1) // limit
-    results = files[(page - 1) * limit : page * limit]
-
-    if not results:
+    limit = settings.page_size
+    hid, handle = await open_handle(parts[1])
+    if not handle or not handle["refs"]:
         return await msg.reply("No results found.")
 
-    if SEND_FILE_INSTEAD_OF_LINK:
-        for f in results:
-            try:
-                await client.copy_message(chat_id=msg.chat.id, from_chat_id=f['chat_id'], message_id=f['message_id'])
-            except:
-                pass
+    if settings.send_files:
+        results, _ = await handle_page(handle, page, limit)
+        deliver(client, msg.chat.id, results)
         return
 
-    text = f"🔍 **Results for:** `{query}` (Page {page}/{total_pages})\n\n"
-    for i, file in enumerate(results, 1):
-        link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
-        text += f"{i}. [{file['caption'][:50]}]({link})\n"
-
-    buttons = []
-    if total_pages > 1:
-        buttons.append([InlineKeyboardButton("Next ⏩", callback_data=f"page_{query}_2")])
-
-    await msg.reply(text, reply_markup=InlineKeyboardMarkup(buttons) if buttons else None, disable_web_page_preview=True)
+    text, has_next = await page_view(handle, page, limit)
+    await msg.reply(text, reply_markup=page_markup(hid, page, has_next), disable_web_page_preview=True)
 
-@app.on_callback_query(filters.regex(r"^page_(.+)_(\d+)$"))
+@app.on_callback_query(filters.regex(r"^pg:([\w-]+):(\d+)$"))
+@timed()
 async def pagination_callback(client, query: CallbackQuery):
-    q, p = query.matches[0].group(1), int(query.matches[0].group(2))
-    files = search_files(q)
-    limit = 5
-    total = len(files)
-    total_pages = (total + limit - 1) // limit
-    results = files[(p - 1) * limit : p * limit]
-    if not results:
-        return await query.answer("No more results.")
-
-    if SEND_FILE_INSTEAD_OF_LINK:
+    hid, p = query.matches[0].group(1), int(query.matches[0].group(2))
+    limit = settings.page_size
+    if not admit(query.from_user.id, "page"):
+        return await query.answer(SLOW_DOWN)
+    if not await debounce(("page", query.message.chat.id, query.message.id), query.id, settings.page_debounce):
+        return await query.answer()
+    handle = await get_handle(hid)
+    if handle is None:
+        return await query.answer("⌛ This search has expired, please search again.", show_alert=True)
+
+    if settings.send_files:
+        results, _ = await handle_page(handle, p, limit)
+        if not results:
+            return await query.answer("No more results.")
         await query.message.delete()
-        for f in results:
-            try:
-                await client.copy_message(chat_id=query.from_user.id, from_chat_id=f['chat_id'], message_id=f['message_id'])
-            except:
-                pass
+        deliver(client, query.from_user.id, results)
         return await query.answer("✅ Files sent via bot.")
 
-    text = f"🔍 **Results for:** `{q}` (Page {p}/{total_pages})\n\n"
-    for i, file in enumerate(results, 1):
-        link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
-        text += f"{i}. [{file['caption'][:50]}]({link})\n"
-
-    nav = []
-    if p > 1:
-        nav.append(InlineKeyboardButton("⏪ Prev", callback_data=f"page_{q}_{p-1}"))
-    if p < total_pages:
-        nav.append(InlineKeyboardButton("Next ⏩", callback_data=f"page_{q}_{p+1}"))
-
-    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup([nav]) if nav else None, disable_web_page_preview=True)
+    text, has_next = await page_view(handle, p, limit)
+    if text is None:
+        return await query.answer("No more results.")
+    try:
+        await query.message.edit_text(text, reply_markup=page_markup(hid, p, has_next), disable_web_page_preview=True)
+    except MessageNotModified:
+        pass
     await query.answer()
 
+async def inline_busy(client, inline_query):
+    await client.answer_inline_query(
+        inline_query.id, results=[], cache_time=0, is_personal=True,
+        switch_pm_text=SLOW_DOWN, switch_pm_parameter="slow_down",
+    )
+
 @app.on_inline_query()
+@timed()
 async def inline_query_handler(client, inline_query: InlineQuery):
+    if not await debounce(inline_query.from_user.id, inline_query.id, settings.inline_debounce):
+        return
+    if not admit(inline_query.from_user.id, "inline"):
+        if should_warn(inline_query.from_user.id):
+            await inline_busy(client, inline_query)
+        return
     ok, _ = await check_force_sub(client, inline_query.from_user.id)
     if not ok:
         return await client.answer_inline_query(
             inline_query.id,
             results=[],
+            cache_time=0,
+            is_personal=True,
             switch_pm_text="🔐 Join required channel & group",
             switch_pm_parameter="force_sub"
         )
 
     query = inline_query.query.strip()
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
     results = []
+    next_offset = ""
     if query:
-        files = search_files(query)[:10]
-        if SEND_FILE_INSTEAD_OF_LINK:
+        files, more = await inline_search(query, offset, settings.inline_page_size)
+        if more:
+            next_offset = str(offset + settings.inline_page_size)
+        if settings.send_files:
             for file in files:
                 results.append(
                     InlineQueryResultArticle(
-                        title=file['caption'][:60],
+                        title=file['caption'][:60] if file['caption'] else "Unnamed",
                         input_message_content=InputTextMessageContent(
                             f"Send this file: /start send_{file['chat_id']}_{file['message_id']}"
                         ),
@@ -579,7 +3733,7 @@ async def inline_query_handler(client, inline_query: InlineQuery):
                 )
         else:
             for file in files:
-                link = f"https://t.me/c/{str(file['chat_id'])[4:]}/{file['message_id']}"
+                link = message_link(file['chat_id'], file['message_id'])
                 title = file['caption'][:60] if file['caption'] else "Unnamed"
                 results.append(
                     InlineQueryResultArticle(
@@ -588,9 +3742,16 @@ async def inline_query_handler(client, inline_query: InlineQuery):
                         description="Click to view",
                     )
                 )
-    await client.answer_inline_query(inline_query.id, results, cache_time=1)
+    await client.answer_inline_query(
+        inline_query.id,
+        results,
+        cache_time=settings.inline_cache_time,
+        is_personal=INLINE_IS_PERSONAL,
+        next_offset=next_offset,
+    )
 
 @app.on_message(filters.command("help"))
+@timed()
 async def help_cmd(client, msg: Message):
     ok, kb = await check_force_sub(client, msg.from_user.id)
     if not ok:
@@ -601,6 +3762,7 @@ async def help_cmd(client, msg: Message):
         "/start - Show welcome message\n"
         "/help - Show this help menu\n"
         "/search <query> - Search for files\n"
+        "  filters: `year:2021` `q:1080p` `lang:hindi` `codec:x265` `s:1` `e:4`\n"
         "/stats - Show bot statistics\n\n"
         "**🔐 Admin Commands:**\n"
         "/indexall - Re-index all files from channels\n"
@@ -612,6 +3774,7 @@ async def help_cmd(client, msg: Message):
     await msg.reply(text, disable_web_page_preview=True)
 
 @app.on_message(filters.command("admin"))
+@timed()
 async def admin_cmd(client, msg: Message):
     if msg.from_user.id != BOT_OWNER_ID:
         return await msg.reply("❌ Only the bot owner can access this panel.")
@@ -620,47 +3783,63 @@ async def admin_cmd(client, msg: Message):
         "**🛠️ Admin Panel**\n\n"
         f"🔗 Force Channel: `{FORCE_CHANNEL}`\n"
         f"👥 Force Group: `{FORCE_GROUP}`\n"
-        f"📤 Send File Mode: `{SEND_FILE_INSTEAD_OF_LINK}`\n"
+        f"📤 Send File Mode: `{settings.send_files}`\n"
     )
     buttons = [
         [InlineKeyboardButton("🔁 Toggle Send Mode", callback_data="toggle_send_mode")],
-        [InlineKeyboardButton("🔄 Reload Config", callback_data="reload_config")]
+        [InlineKeyboardButton("🔄 Reload Settings", callback_data="reload_config")]
     ]
     await msg.reply(text, reply_markup=InlineKeyboardMarkup(buttons))
 
 @app.on_callback_query(filters.regex("toggle_send_mode"))
+@timed()
 async def toggle_send_mode(client, cb: CallbackQuery):
     if cb.from_user.id != BOT_OWNER_ID:
         return await cb.answer("Unauthorized", show_alert=True)
 
-    new_state = not SEND_FILE_INSTEAD_OF_LINK
-    with open("config.py", "r") as f:
-        content = f.read()
-    content = content.replace(
-        f"SEND_FILE_INSTEAD_OF_LINK = {SEND_FILE_INSTEAD_OF_LINK}",
-        f"SEND_FILE_INSTEAD_OF_LINK = {new_state}"
-    )
-    with open("config.py", "w") as f:
-        f.write(content)
-    await cb.answer("Toggled send mode.", show_alert=True)
-    await cb.message.edit_text("✅ Send mode toggled. Please restart the bot to apply changes.")
+    await settings.set("send_files", not settings.send_files)
+    await cb.answer(f"📤 Send File Mode: {settings.send_files}", show_alert=True)
+    await cb.message.edit_text(f"✅ Send File Mode is now `{settings.send_files}`.")
 
 @app.on_callback_query(filters.regex("reload_config"))
+@timed()
 async def reload_config(client, cb: CallbackQuery):
     if cb.from_user.id != BOT_OWNER_ID:
         return await cb.answer("Unauthorized", show_alert=True)
-    importlib.reload(cfg)
-    await cb.answer("🔄 Config reloaded.", show_alert=True)
-    await cb.message.edit_text("✅ Configuration reloaded successfully.")
+    await settings.load()
+    await cb.answer("🔄 Settings reloaded.", show_alert=True)
+    await cb.message.edit_text("✅ Settings reloaded from the database.")
 
 @app.on_message(filters.command("stats"))
+@timed()
 async def stats_cmd(client, msg: Message):
     ok, kb = await check_force_sub(client, msg.from_user.id)
     if not ok:
         return await msg.reply("🔒 Please join required channels to use the bot.", reply_markup=kb)
 
-    total_users = get_total_user_count()
-    total_files = get_total_file_count()
+    total_users, total_files = await asyncio.gather(get_total_user_count(), get_total_file_count())
     await msg.reply(f"📊 Stats:\n👤 Users: {total_users}\n📁 Files: {total_files}")
 
-app.run()
+async def main():
+    await registry.load()
+    await settings.load()
+    await app.start()
+    refresher = asyncio.create_task(settings.run())
+    flusher = asyncio.create_task(registry.run(USER_FLUSH_INTERVAL))
+    lag = asyncio.create_task(monitor_loop_lag())
+    server = await serve(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    asyncio.create_task(load_caption_index())
+    snapshots = asyncio.create_task(run_caption_snapshots(CAPTION_SNAPSHOT_INTERVAL))
+    await idle()
+    refresher.cancel()
+    flusher.cancel()
+    snapshots.cancel()
+    lag.cancel()
+    if server:
+        server.close()
+    await app.stop()
+    await registry.flush()
+    await save_caption_index()
+
+if __name__ == "__main__":
+    app.run(main())